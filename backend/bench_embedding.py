@@ -0,0 +1,132 @@
+'''
+这个代码用于对比不同嵌入后端（torch / onnx / onnx+int8）：
+1. 一致性：onnx 的向量和 sentence-transformers 的余弦相似度要 >= 0.99，否则老向量库里的向量和新向量没法混用
+2. 性能：每秒能编码多少句、进程峰值内存多少
+每个后端在单独的子进程里跑，内存互不干扰
+用法：python bench_embedding.py [句子条数]
+需要 models/all-MiniLM-L6-v2 下有模型（onnx 后端第一次跑会自动导出 model.onnx）
+onnx 后端需要 onnxruntime + tokenizers，第一次导出还要 torch + transformers（torch.onnx.export），int8 量化要 onnx（见 requirements.txt）
+某个后端跑不起来（缺依赖、崩溃、超过 BENCH_TIMEOUT 秒）只跳过它，不会卡住
+'''
+import multiprocessing
+import os
+import queue as queue_module
+import resource
+import sys
+import time
+import numpy as np
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'all-MiniLM-L6-v2')
+MIN_COSINE = 0.99
+# 单个后端最多跑多少秒（含第一次导出 / 量化模型）
+BENCH_TIMEOUT = float(os.getenv("BENCH_TIMEOUT", "900"))
+
+BACKENDS = [
+    ("torch", False),
+    ("onnx", False),
+    ("onnx", True),
+]
+
+def make_sentences(n):
+    '''
+    造一批长短不一的中英文句子（长度不齐才能看出按长度分批的效果）
+    '''
+    base = [
+        "Transformer 模型在长文本上的注意力开销是平方级的",
+        "We propose a retrieval augmented method for scientific question answering.",
+        "稀疏注意力可以降低计算量，但可能损失远距离依赖。",
+        "The experiments show a 3.5% improvement over the strongest baseline on all benchmarks, "
+        "although the gains shrink when the training data is limited to a few thousand examples.",
+        "这篇论文的主要局限是只在英文数据集上做了评测",
+        "contrastive learning",
+    ]
+    return [f"{base[i % len(base)]} ({i})" * (1 + i % 4) for i in range(n)]
+
+def _run_backend(backend, quantize, sentences, queue):
+    # 子进程里的异常（比如没装 onnxruntime）要传回父进程，否则父进程会一直等结果
+    try:
+        from vector_memory import LocalEmbeddingFunction
+
+        embed = LocalEmbeddingFunction(MODEL_PATH, backend=backend, quantize=quantize)
+        t0 = time.perf_counter()
+        embed.warm_up()
+        load_seconds = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        vectors = np.asarray(embed(sentences), dtype=np.float32)
+        seconds = time.perf_counter() - t0
+    except BaseException as e:
+        queue.put(("error", repr(e)))
+        return
+    # ru_maxrss 在 Linux 上单位是 KB
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put(("ok", {
+        "load_seconds": load_seconds,
+        "throughput": len(sentences) / seconds,
+        "peak_mb": peak_mb,
+        "vectors": vectors
+    }))
+
+def run_backend(backend, quantize, sentences, timeout=BENCH_TIMEOUT):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_backend, args=(backend, quantize, sentences, queue))
+    proc.start()
+    # 每秒看一次子进程还活着没有：崩溃（段错误、被 OOM 杀掉）时不会有结果，不能一直等下去
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                status, payload = queue.get(timeout=1)
+                break
+            except queue_module.Empty:
+                if not proc.is_alive():
+                    # 退出前刚好放进去的结果再取一次
+                    try:
+                        status, payload = queue.get(timeout=1)
+                        break
+                    except queue_module.Empty:
+                        raise RuntimeError(f"子进程异常退出，exitcode={proc.exitcode}")
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"超过 {timeout:.0f}s 没跑完")
+    finally:
+        if proc.is_alive():
+            proc.terminate()
+        proc.join()
+    if status == "error":
+        raise RuntimeError(payload)
+    return payload
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    sentences = make_sentences(n)
+    print(f"=== 嵌入后端对比：{n} 条句子 ===")
+
+    results = {}
+    for backend, quantize in BACKENDS:
+        label = backend + ("+int8" if quantize else "")
+        try:
+            results[label] = run_backend(backend, quantize, sentences)
+        except Exception as e:
+            print(f"❌ {label} 跑不起来: {e}")
+            continue
+        r = results[label]
+        print(f"{label:<10} 加载 {r['load_seconds']:.2f}s | {r['throughput']:.1f} 句/秒 | 峰值内存 {r['peak_mb']:.0f} MB")
+
+    reference = results.get("torch")
+    if reference is None:
+        print("没有 torch 的结果，跳过一致性检查")
+        return
+    ok = True
+    for label, r in results.items():
+        if label == "torch":
+            continue
+        # 两边都是归一化向量，点积就是余弦
+        cosine = (reference["vectors"] * r["vectors"]).sum(axis=1)
+        passed = cosine.min() >= MIN_COSINE
+        ok = ok and passed
+        print(f"{'✅' if passed else '❌'} {label} vs torch: 最小余弦 {cosine.min():.4f}，平均 {cosine.mean():.4f}")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+'''
+此代码用于把论文全文切成带重叠的小块（按章节感知），供深度阅读模式按问题检索
+切块规则：
+1. 先按章节标题（Abstract / 1 Introduction / 2.1 Method / 一、引言 ...）分段
+2. 段内按句子累积，凑够 chunk_size 个字符就切一块
+3. 相邻两块之间保留 overlap 个字符左右的句子重叠，避免答案被切断
+4. 读到参考文献就停，参考文献对问答没用
+'''
+import os
+import re
+
+# 每块大约多少字符，以及相邻块的重叠字符数
+CHUNK_SIZE = int(os.getenv("PAPER_CHUNK_SIZE", "800"))
+CHUNK_OVERLAP = int(os.getenv("PAPER_CHUNK_OVERLAP", "150"))
+
+# 章节标题：编号 + 标题式大小写的短标题 / 编号 + 常见章节词 / 常见英文章节名 / 中文编号标题 / 常见中文章节名
+# 标题里不能有数字和句子标点，"10 Hz sampling was used"、"1 BERT 85.3" 这种正文行、表格行不算标题
+_NUMBER = r"(?:\d{1,2}(?:\.\d{1,2}){0,2}|[IVX]{1,4})\.?\s+"
+_TITLE_WORD = r"[A-Z][A-Za-z'\-]*"
+_SMALL_WORD = r"(?:a|an|and|as|at|by|for|from|in|of|on|or|the|to|via|vs|with)"
+_SECTION_WORDS = (
+    r"(?:abstract|introduction|related work|background|preliminar(?:y|ies)|methods?|methodology|approach"
+    r"|proposed|models?|experiments?|experimental|evaluation|results|analysis|discussion|limitations?"
+    r"|conclusions?|appendix|references|bibliography|acknowledg(?:e)?ments?)"
+)
+HEADING_RE = re.compile(
+    r"^(?:"
+    rf"(?-i:{_NUMBER}{_TITLE_WORD}(?:[ ]+(?:{_TITLE_WORD}|{_SMALL_WORD})){{0,7}})"
+    rf"|{_NUMBER}{_SECTION_WORDS}\b[A-Za-z \-]{{0,40}}"
+    rf"|{_SECTION_WORDS}"
+    r"|[一二三四五六七八九十]{1,3}[、.．]\s*[^\s，。；！？,;]{1,20}"
+    r"|(?:摘\s*要|引\s*言|相关工作|方法|实验|结\s*论|参考文献|致\s*谢)"
+    r")$",
+    re.I
+)
+REFERENCES_RE = re.compile(r"^(?:references|bibliography|参考文献)$", re.I)
+# 中文句末标点直接切；英文句号后面要跟空白才切（避免把 3.5、e.g. 之类切开太多）
+SENTENCE_RE = re.compile(r"(?<=[。！？；])|(?<=[.!?;])\s+")
+
+class PaperChunker:
+    '''
+    流式切块器：可以一页一页地 feed 文本，每次返回已经切好的块
+    块的格式: {"text": 内容, "section": 所属章节, "index": 第几块}
+    章节标题既记在 section 里，也留在这一节第一块的正文开头
+    '''
+    def __init__(self,chunk_size=CHUNK_SIZE,overlap=CHUNK_OVERLAP):
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.section = "正文"
+        self.index = 0
+        self.stopped = False # 读到参考文献后不再切
+        self._sentences = [] # 当前块里已经攒下的句子
+        self._length = 0
+        self._pending = "" # 上一次 feed 末尾没读完的半行
+
+    def feed(self,text):
+        '''
+        喂入一段文本（比如一页），返回这段文本新产生的完整块
+        '''
+        chunks = []
+        if self.stopped or not text:
+            return chunks
+        lines = (self._pending + text).split("\n")
+        # 最后一行可能被分页截断了，留到下次
+        self._pending = lines.pop()
+        for line in lines:
+            chunks.extend(self._feed_line(line))
+            if self.stopped:
+                break
+        return chunks
+
+    def finish(self):
+        '''
+        全部喂完后调用，把剩下的内容也切出来
+        '''
+        chunks = []
+        if self._pending and not self.stopped:
+            chunks.extend(self._feed_line(self._pending))
+        self._pending = ""
+        chunks.extend(self._flush(keep_overlap=False))
+        return chunks
+
+    def _feed_line(self,line):
+        chunks = []
+        line = line.strip()
+        if not line:
+            return chunks
+        # 章节标题：先把上一节收尾，再切换章节；标题这一行照样放进正文（万一认错了也不丢内容）
+        if len(line) <= 90 and HEADING_RE.match(line):
+            chunks.extend(self._flush(keep_overlap=False))
+            if REFERENCES_RE.match(line):
+                self.stopped = True
+                return chunks
+            self.section = line
+        for sentence in SENTENCE_RE.split(line):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            # 超长的句子（公式、表格）硬切
+            while len(sentence) > self.chunk_size:
+                chunks.extend(self._add_sentence(sentence[:self.chunk_size]))
+                sentence = sentence[self.chunk_size:]
+            chunks.extend(self._add_sentence(sentence))
+        return chunks
+
+    def _add_sentence(self,sentence):
+        chunks = []
+        if self._length + len(sentence) > self.chunk_size and self._sentences:
+            chunks.extend(self._flush(keep_overlap=True))
+        self._sentences.append(sentence)
+        self._length += len(sentence)
+        return chunks
+
+    def _flush(self,keep_overlap):
+        if not self._sentences:
+            return []
+        # 英文句子之间补空格，中文直接拼
+        text = " ".join(self._sentences) if self._is_latin() else "".join(self._sentences)
+        chunk = {"text": text, "section": self.section, "index": self.index}
+        self.index += 1
+
+        # 从尾部往前取句子作为下一块的开头（重叠部分）
+        tail = []
+        tail_len = 0
+        if keep_overlap:
+            for sentence in reversed(self._sentences):
+                if tail_len + len(sentence) > self.overlap:
+                    break
+                tail.insert(0, sentence)
+                tail_len += len(sentence)
+        self._sentences = tail
+        self._length = tail_len
+        return [chunk]
+
+    def _is_latin(self):
+        sample = "".join(self._sentences)[:200]
+        return sum(1 for ch in sample if ord(ch) < 128) > len(sample) * 0.5
+
+def chunk_text(text,chunk_size=CHUNK_SIZE,overlap=CHUNK_OVERLAP):
+    '''
+    一次性把整篇全文切块
+    '''
+    chunker = PaperChunker(chunk_size=chunk_size, overlap=overlap)
+    return chunker.feed(text) + chunker.finish()
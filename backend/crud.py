@@ -1,7 +1,12 @@
 '''
 此代码用于修改、存储数据
 '''
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+import datetime
+import json
+import zlib
 import models, schemas
 
 # --- User 相关 ---
@@ -11,25 +16,29 @@ def get_user_by_username(db: Session, username: str): # 根据用户名找对象
 def get_user(db: Session, user_id: int):
     return db.query(models.User).filter(models.User.id == user_id).first()
 
-def create_user(db: Session, user: schemas.UserCreate):
+# commit=False：只 flush（拿到自增 id），不提交，由调用方把几次写入放进同一个事务里一起 commit
+def _save(db: Session, obj, commit: bool):
+    db.add(obj) # 将对象加入对话，等待提交
+    if commit:
+        db.commit() # 写入数据库
+        db.refresh(obj) # 重新加载对象属性
+    else:
+        db.flush()
+    return obj
+
+def create_user(db: Session, user: schemas.UserCreate, commit: bool = True):
     # 这里只是简单的存数据，不涉及复杂逻辑
     fake_hashed_password = user.password + "notreallyhashed"
     db_user = models.User(username=user.username, password_hash=fake_hashed_password)
-    db.add(db_user) # 将对象加入对话，等待提交
-    db.commit() # 写入数据库
-    db.refresh(db_user) # 重新加载对象属性
-    return db_user
+    return _save(db, db_user, commit)
 
 # --- Idea 相关 ---
-def create_idea(db: Session, idea: schemas.IdeaCreate, user_id: int):
+def create_idea(db: Session, idea: schemas.IdeaCreate, user_id: int, commit: bool = True):
     '''
     创建新idea
     '''
     db_idea = models.Idea(**idea.dict(), user_id=user_id)
-    db.add(db_idea)
-    db.commit()
-    db.refresh(db_idea)
-    return db_idea
+    return _save(db, db_idea, commit)
 
 def update_idea_content(db: Session, idea_id: int, new_content: str):
     """
@@ -47,10 +56,108 @@ def update_idea_content(db: Session, idea_id: int, new_content: str):
     return db_idea
 
 # --- Paper 相关 (为 PDF 上传做准备) ---
-def create_paper_record(db: Session, paper: schemas.PaperCreate, user_id: int):
+def create_paper_record(db: Session, paper: schemas.PaperCreate, user_id: int, commit: bool = True):
     # 自动把 schema 里的所有字段（包括 full_text）都传进去
     db_paper = models.Paper(**paper.dict(), user_id=user_id)
-    db.add(db_paper)
-    db.commit()
-    db.refresh(db_paper)
-    return db_paper
+    return _save(db, db_paper, commit)
+
+def get_paper_content(db: Session, content_hash: str):
+    return db.query(models.PaperContent).filter(models.PaperContent.content_hash == content_hash).first()
+
+def create_paper_content(db: Session, content: models.PaperContent, commit: bool = True):
+    return _save(db, content, commit)
+
+# 论文全文压缩存储：纯文本压缩率一般有 3~4 倍，zlib 标准库自带，解压一篇几毫秒
+def compress_text(text: str):
+    return zlib.compress(text.encode("utf-8"), 6) if text else None
+
+def decompress_text(blob: bytes):
+    return zlib.decompress(blob).decode("utf-8") if blob else None
+
+def get_content_full_text(content: models.PaperContent):
+    """
+    PaperContent 的全文：优先读压缩列，老数据读未压缩的列
+    """
+    if content.full_text_z:
+        return decompress_text(content.full_text_z)
+    return content.full_text
+
+def get_paper_full_text(db: Session, paper: models.Paper):
+    """
+    取论文全文：老数据存在 Paper 上，去重后的新数据存在 PaperContent 上
+    全文列都是延迟加载的，只有深度阅读真正要用时才走到这里，只查全文这一两列
+    """
+    if paper.full_text:
+        return paper.full_text
+    if paper.content_hash:
+        row = db.query(models.PaperContent.full_text_z, models.PaperContent.full_text).filter(
+            models.PaperContent.content_hash == paper.content_hash
+        ).first()
+        if row:
+            return decompress_text(row.full_text_z) if row.full_text_z else row.full_text
+    return None
+
+# --- 消息相关 ---
+def create_message(db: Session, user_id: int, idea_id, role: str, content: str, created_at=None, commit: bool = True):
+    db_msg = models.Message(content=content, role=role, user_id=user_id, idea_id=idea_id)
+    if created_at is not None:
+        db_msg.created_at = created_at
+    return _save(db, db_msg, commit)
+
+# 游标分页：游标就是上一页最后一条消息的 "created_at,id"，下一页从它后面接着取
+# 比 OFFSET 翻页好在不管翻到多深都只走一次索引定位，消息表再大也是 O(log n)
+def encode_cursor(msg):
+    return f"{msg.created_at.isoformat()},{msg.id}"
+
+def decode_cursor(cursor: str):
+    """
+    游标格式不对时抛 ValueError
+    """
+    created_at, msg_id = cursor.rsplit(",", 1)
+    return datetime.datetime.fromisoformat(created_at), int(msg_id)
+
+def after_cursor(cursor, descending: bool = False):
+    """
+    (created_at, id) 在游标之后的过滤条件；descending=True 表示从新往旧翻
+    """
+    created_at, msg_id = cursor
+    if descending:
+        return or_(models.Message.created_at < created_at,
+                   and_(models.Message.created_at == created_at, models.Message.id < msg_id))
+    return or_(models.Message.created_at > created_at,
+               and_(models.Message.created_at == created_at, models.Message.id > msg_id))
+
+async def get_idea_messages_page(db: AsyncSession, idea_id: int, limit: int = 50, cursor: str = None):
+    """
+    从最新的消息往前翻一页，返回 (按时间正序的消息列表, 下一页游标)，没有更早的消息时游标为 None
+    """
+    order = (models.Message.created_at.desc(), models.Message.id.desc())
+    stmt = select(models.Message).where(models.Message.idea_id == idea_id)
+    if cursor:
+        stmt = stmt.where(after_cursor(decode_cursor(cursor), descending=True))
+    # 多取一条，用来判断还有没有下一页
+    rows = list((await db.scalars(stmt.order_by(*order).limit(limit + 1))).all())
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, next_cursor
+
+# --- 后台任务相关 ---
+async def get_ingest_job(db: AsyncSession, job_id: str):
+    return await db.get(models.IngestJob, job_id)
+
+# --- 睡眠知识相关 ---
+def save_knowledge(db: Session, user_id: int, items):
+    """
+    记下睡眠整理出的知识，items: [(向量库 id, 原文, 标签列表)]
+    同一条知识（向量库 id 相同）只记一次，由调用方 commit
+    """
+    memory_ids = [mem_id for mem_id, _, _ in items]
+    existing = {
+        mem_id for (mem_id,) in db.query(models.Knowledge.memory_id).filter(models.Knowledge.memory_id.in_(memory_ids))
+    }
+    for mem_id, content, tags in items:
+        if mem_id in existing:
+            continue
+        existing.add(mem_id)
+        db.add(models.Knowledge(user_id=user_id, content=content, tags=json.dumps(tags, ensure_ascii=False), memory_id=mem_id))
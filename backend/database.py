@@ -1,27 +1,115 @@
 '''
 此代码用于创建数据库
+- 连接串从环境变量 DATABASE_URL 读，默认是当前目录下的 SQLite 文件 research.db；换成 MySQL / Postgres 只要改 URL
+- 同步引擎 + SessionLocal：睡眠整理、后台解析任务、reindex 这些跑在线程/脚本里的代码用
+- 异步引擎 + AsyncSessionLocal：FastAPI 的 async 接口用（get_async_db），查库时不阻塞事件循环
+- SQLite 每个连接都打开 WAL：读写互不阻塞，对话、上传、睡眠同时写库时只排队写锁，不再互相卡住
 '''
-from sqlalchemy import create_engine
+import os
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 from models import Base
 
-# 数据库放在当前目录，叫 research.db
-SQLALCHEMY_DATABASE_URL = "sqlite:///./research.db"
+load_dotenv()
+
+# 数据库默认放在当前目录，叫 research.db
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./research.db")
+# 连接池：常驻连接数 / 高峰时额外允许的连接数 / 等连接的超时秒数
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+# SQLite 写锁被占用时最多等多少毫秒（而不是立刻报 database is locked）
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# 同步驱动 -> 对应的异步驱动
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+def to_async_url(url: str):
+    '''
+    sqlite:///./research.db -> sqlite+aiosqlite:///./research.db，已经写了驱动的按原样用
+    '''
+    url = make_url(url)
+    if url.drivername in ASYNC_DRIVERS:
+        url = url.set(drivername=ASYNC_DRIVERS[url.drivername])
+    return url
+
+IS_SQLITE = make_url(SQLALCHEMY_DATABASE_URL).get_backend_name() == "sqlite"
+
+def _engine_kwargs():
+    if IS_SQLITE and make_url(SQLALCHEMY_DATABASE_URL).database in (None, "", ":memory:"):
+        # 内存库只能有一个连接，用 SQLAlchemy 默认的单连接池
+        return {"connect_args": {"check_same_thread": False}}
+    kwargs = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT}
+    if IS_SQLITE:
+        # check_same_thread=False 是 SQLite 在 Web 框架下必须的设置
+        kwargs["connect_args"] = {"check_same_thread": False}
+    else:
+        # 服务端数据库：借出连接前先探活，定期换掉旧连接（MySQL 默认 8 小时断开空闲连接）
+        kwargs.update(pool_pre_ping=True, pool_recycle=3600)
+    return kwargs
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    '''
+    每个新连接都设置一遍（synchronous / busy_timeout 是连接级别的）
+    WAL 下 synchronous=NORMAL 是安全的：断电最多丢最后几个事务，不会损坏数据库
+    '''
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
 
 # 创建引擎
-# check_same_thread=False 是 SQLite 在 Web 框架下必须的设置
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **_engine_kwargs())
+# 异步引擎，和同步引擎连的是同一个库
+async_engine = create_async_engine(to_async_url(SQLALCHEMY_DATABASE_URL), **_engine_kwargs())
+
+if IS_SQLITE:
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
 
 # 创建会话工厂，一个引擎可以对应许多不同的会话
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# 异步会话工厂；commit 后不让对象过期，接口返回 ORM 对象时不会再去触发（异步下不允许的）懒加载
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
 
 # 初始化数据库，根据model中的base进行创建
 def init_db():
     print("正在初始化数据库...")
     Base.metadata.create_all(bind=engine)
-    print("数据库文件 research.db 已生成！")
+    migrate()
+    print(f"数据库已就绪：{engine.url.render_as_string(hide_password=True)}")
+
+# 简易迁移：create_all 只会建新表，老表上新增的列和索引要自己补
+# （只处理新增的可空列和新索引，够用了；复杂的表结构变更请用 alembic）
+def migrate():
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_cols = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_cols:
+                    continue
+                col_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'))
+                print(f"[迁移] {table.name} 新增列 {column.name}")
+            existing_indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                # 大表上建索引要扫一遍全表，只在第一次启动时发生
+                index.create(bind=conn)
+                print(f"[迁移] {table.name} 新增索引 {index.name}")
 
 # 给 FastAPI 用的依赖项 (借用数据库连接，用完自动关)
 def get_db():
@@ -31,6 +119,11 @@ def get_db():
     finally:
         db.close()
 
+# 给 async 接口用的依赖项
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 # 如果直接运行这个文件，就执行初始化
 if __name__ == "__main__":
     init_db()
\ No newline at end of file
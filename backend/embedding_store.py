@@ -0,0 +1,149 @@
+'''
+此代码是磁盘上的嵌入向量缓存：文本内容哈希 -> float32 向量
+- 向量按行追加写进一个内存映射文件（每个模型一个），读的时候不用整个载入内存
+- 哈希 -> 行号的索引放在 sqlite 里
+- 重建 Chroma 集合（改 schema、换集合名、数据损坏恢复）时，文档向量直接从这里读，不用再跑模型
+多个进程（服务 + reindex 脚本）可以同时用：写入靠 sqlite 的写锁串行，读的时候发现文件变长了就重新映射
+'''
+import hashlib
+import os
+import sqlite3
+import threading
+import numpy as np
+
+# 向量缓存放在哪个目录
+EMBED_STORE_DIR = os.getenv("EMBED_STORE_DIR", "./embedding_store")
+# 映射文件每次至少扩多少行
+GROW_ROWS = 4096
+
+def content_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingStore:
+    '''
+    model_key:模型标识，不同模型（或量化版本）的向量互不混用
+    '''
+    def __init__(self,model_key,path=EMBED_STORE_DIR):
+        os.makedirs(path, exist_ok=True)
+        self.model_key = model_key
+        self.vector_path = os.path.join(path, f"{hashlib.sha1(model_key.encode('utf-8')).hexdigest()[:16]}.f32")
+        self._lock = threading.Lock()
+        self._array = None
+        self.dim = None
+        self.hits = 0
+        self.misses = 0
+
+        # isolation_level=None：事务由我们自己 BEGIN/COMMIT
+        self._db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY, dim INTEGER NOT NULL, rows INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS vectors (model TEXT NOT NULL, key TEXT NOT NULL, row INTEGER NOT NULL, PRIMARY KEY (model, key))")
+        row = self._db.execute("SELECT dim FROM models WHERE model = ?", (model_key,)).fetchone()
+        if row:
+            self.dim = row[0]
+
+    def _map(self,min_rows=0):
+        '''
+        (重新)映射向量文件，保证至少能访问 min_rows 行；文件不够大时扩容
+        '''
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self.vector_path) if os.path.exists(self.vector_path) else 0
+        if size < min_rows * row_bytes:
+            size = max(min_rows, size // row_bytes + GROW_ROWS) * row_bytes
+            with open(self.vector_path, "ab") as f:
+                f.truncate(size)
+        if self._array is None or len(self._array) * row_bytes != size:
+            self._array = np.memmap(self.vector_path, dtype=np.float32, mode="r+", shape=(size // row_bytes, self.dim))
+        return self._array
+
+    def get_many(self,texts):
+        '''
+        按文本查缓存的向量，返回和 texts 一一对应的列表，没缓存的位置是 None
+        '''
+        result = [None] * len(texts)
+        if self.dim is None or not texts:
+            self.misses += len(texts)
+            return result
+        keys = [content_key(t) for t in texts]
+        rows = {}
+        with self._lock:
+            unique = list(set(keys))
+            for start in range(0, len(unique), 500):
+                part = unique[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows.update(self._db.execute(
+                    f"SELECT key, row FROM vectors WHERE model = ? AND key IN ({placeholders})",
+                    [self.model_key] + part
+                ).fetchall())
+            if rows:
+                array = self._map()
+                if max(rows.values()) >= len(array):
+                    array = self._map(max(rows.values()) + 1) # 别的进程写长了
+                for i, key in enumerate(keys):
+                    if key in rows:
+                        result[i] = np.array(array[rows[key]])
+        found = sum(1 for r in result if r is not None)
+        self.hits += found
+        self.misses += len(texts) - found
+        return result
+
+    def put_many(self,texts,vectors):
+        '''
+        把新算出来的向量写进缓存（已经有的跳过）
+        先写向量文件再提交索引，中途崩了最多浪费几行空间，不会读到坏向量
+        '''
+        if not texts:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            # BEGIN IMMEDIATE 拿到跨进程的写锁，行号分配不会冲突
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT dim, rows FROM models WHERE model = ?", (self.model_key,)).fetchone()
+                if row is None:
+                    self.dim, next_row = vectors.shape[1], 0
+                    self._db.execute("INSERT INTO models (model, dim, rows) VALUES (?, ?, 0)", (self.model_key, self.dim))
+                else:
+                    self.dim, next_row = row
+                    if vectors.shape[1] != self.dim:
+                        raise ValueError(f"向量维度 {vectors.shape[1]} 和缓存里的 {self.dim} 不一致")
+
+                pending = {}
+                for text, vector in zip(texts, vectors):
+                    pending[content_key(text)] = vector
+                keys = list(pending.keys())
+                existing = set()
+                for start in range(0, len(keys), 500):
+                    part = keys[start:start + 500]
+                    placeholders = ",".join("?" * len(part))
+                    existing.update(k for (k,) in self._db.execute(
+                        f"SELECT key FROM vectors WHERE model = ? AND key IN ({placeholders})",
+                        [self.model_key] + part
+                    ))
+                new_keys = [k for k in keys if k not in existing]
+                if new_keys:
+                    array = self._map(next_row + len(new_keys))
+                    for offset, key in enumerate(new_keys):
+                        array[next_row + offset] = pending[key]
+                    array.flush()
+                    self._db.executemany(
+                        "INSERT INTO vectors (model, key, row) VALUES (?, ?, ?)",
+                        [(self.model_key, key, next_row + offset) for offset, key in enumerate(new_keys)]
+                    )
+                    self._db.execute("UPDATE models SET rows = ? WHERE model = ?", (next_row + len(new_keys), self.model_key))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def stats(self):
+        with self._lock:
+            row = self._db.execute("SELECT rows FROM models WHERE model = ?", (self.model_key,)).fetchone()
+        total = self.hits + self.misses
+        return {
+            'model': self.model_key,
+            'vectors': row[0] if row else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
@@ -0,0 +1,195 @@
+'''
+此代码是论文上传的后台任务队列
+- /upload_paper/ 只负责把文件落盘、建一条任务记录，然后立刻返回 job_id
+- 真正的解析、摘要、入库由这里的 worker 在后台完成，同时最多跑 INGEST_WORKERS 个
+- 任务状态存在 SQL 的 ingest_jobs 表里，服务重启后没跑完的任务会重新排队
+- deepseek 摘要失败会退避重试，最后一次仍失败才退化为截取前500字
+- 任务表的读写都在线程里做（_recover / _create_job / _claim / _update），提交等写锁时不卡事件循环
+'''
+import asyncio
+import os
+import uuid
+from fastapi import UploadFile
+from database import SessionLocal
+import models
+import pdf_ingest
+import services
+
+# 上传文件落盘目录（任务跑完就删）
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "./uploads")
+# 同时处理几篇论文
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# 每篇论文最多尝试几次
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+# 重试的基础退避秒数（第 n 次失败后等 base * 2^(n-1) 秒）
+INGEST_RETRY_BACKOFF = float(os.getenv("INGEST_RETRY_BACKOFF", "2"))
+
+class IngestQueue:
+    def __init__(self,workers=INGEST_WORKERS,max_attempts=INGEST_MAX_ATTEMPTS):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._queue = None
+        self._tasks = []
+        self._retry_tasks = set() # 等待重试的定时任务，留着引用防止被回收
+
+    async def start(self):
+        '''
+        启动 worker，并把上次没跑完的任务重新排队
+        '''
+        self._queue = asyncio.Queue()
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+        unfinished = await asyncio.to_thread(self._recover)
+        for job_id in unfinished:
+            self._queue.put_nowait(job_id)
+        if unfinished:
+            print(f"[任务队列] 恢复了 {len(unfinished)} 个未完成的解析任务")
+
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        tasks = self._tasks + list(self._retry_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._retry_tasks.clear()
+
+    async def submit(self,user_id: int,idea_id: int,file: UploadFile):
+        '''
+        把上传文件落盘并建任务，立刻返回任务记录
+        '''
+        file_path, _ = await pdf_ingest.spool_upload(file, directory=UPLOAD_DIR)
+        try:
+            job = await asyncio.to_thread(self._create_job, user_id, idea_id, file.filename, file_path)
+        except Exception:
+            os.remove(file_path)
+            raise
+        self._queue.put_nowait(job.id)
+        return job
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                print(f"[任务队列] 任务 {job_id} 异常: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self,job_id: str):
+        job = await asyncio.to_thread(self._claim, job_id)
+        if job is None:
+            return
+
+        # 最后一次机会时允许摘要退化，保证论文至少能入库
+        last_attempt = job["attempts"] >= self.max_attempts
+        db = SessionLocal()
+        try:
+            db_paper = await services.ingest_paper_file(
+                job["user_id"], job["idea_id"], job["file_path"], job["filename"], db,
+                allow_fallback=last_attempt
+            )
+            paper_id = db_paper.id
+        except services.PaperSummaryError as e:
+            await asyncio.to_thread(self._update, job_id, status="queued", error=f"第 {job['attempts']} 次摘要失败: {e}")
+            delay = INGEST_RETRY_BACKOFF * (2 ** (job["attempts"] - 1))
+            print(f"[任务队列] {job['filename']} 摘要失败，{delay:.0f}s 后重试")
+            retry = asyncio.create_task(self._requeue_later(job_id, delay))
+            self._retry_tasks.add(retry)
+            retry.add_done_callback(self._retry_tasks.discard)
+            return
+        except Exception as e:
+            await asyncio.to_thread(db.rollback)
+            await asyncio.to_thread(self._update, job_id, status="failed", error=str(e))
+            self._remove_file(job["file_path"])
+            return
+        finally:
+            await asyncio.to_thread(db.close)
+
+        await asyncio.to_thread(self._update, job_id, status="done", paper_id=paper_id, error=None)
+        self._remove_file(job["file_path"])
+
+    @staticmethod
+    def _recover():
+        '''
+        上次跑到一半被打断的任务重新排队，返回任务 id（按创建时间）
+        '''
+        db = SessionLocal()
+        try:
+            unfinished = db.query(models.IngestJob).filter(
+                models.IngestJob.status.in_(["queued", "running"])
+            ).order_by(models.IngestJob.created_at.asc()).all()
+            for job in unfinished:
+                job.status = "queued"
+            ids = [job.id for job in unfinished]
+            db.commit()
+            return ids
+        finally:
+            db.close()
+
+    @staticmethod
+    def _create_job(user_id: int, idea_id: int, filename: str, file_path: str):
+        db = SessionLocal()
+        try:
+            job = models.IngestJob(
+                id=uuid.uuid4().hex,
+                status="queued",
+                user_id=user_id,
+                idea_id=idea_id,
+                filename=filename,
+                file_path=file_path
+            )
+            db.add(job)
+            db.commit()
+            db.refresh(job)
+            return job
+        finally:
+            db.close()
+
+    @staticmethod
+    def _claim(job_id: str):
+        '''
+        把排队中的任务标记为运行中，返回跑任务要用的字段；任务不存在或不在排队就返回 None
+        '''
+        db = SessionLocal()
+        try:
+            job = db.query(models.IngestJob).filter(models.IngestJob.id == job_id).first()
+            if not job or job.status != "queued":
+                return None
+            job.status = "running"
+            job.attempts += 1
+            db.commit()
+            return {
+                "user_id": job.user_id,
+                "idea_id": job.idea_id,
+                "file_path": job.file_path,
+                "filename": job.filename,
+                "attempts": job.attempts
+            }
+        finally:
+            db.close()
+
+    @staticmethod
+    def _update(job_id: str, **fields):
+        db = SessionLocal()
+        try:
+            job = db.get(models.IngestJob, job_id)
+            for key, value in fields.items():
+                setattr(job, key, value)
+            db.commit()
+        finally:
+            db.close()
+
+    async def _requeue_later(self,job_id: str,delay: float):
+        await asyncio.sleep(delay)
+        self._queue.put_nowait(job_id)
+
+    @staticmethod
+    def _remove_file(path):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+# 全局唯一的上传任务队列
+ingest_queue = IngestQueue()
@@ -0,0 +1,260 @@
+'''
+此代码是和 Chroma 集合并行维护的关键词索引（SQLite FTS5 + BM25）
+向量检索对模型名、数据集名、中文术语这类"字面要对上"的词不敏感，关键词索引专门补这一块
+- 分词：英文/数字按词切（bert-base、resnet50 算一个词），中文按相邻两字切（"注意力机制" -> 注意 意力 力机 机制）
+- 切好的词用空格拼起来交给 FTS5，查询也用同样的切法，按 bm25 排序
+- 过滤：metadata 里的标量字段（user_id / idea_id / in_idea_* / role / paper_db_id ...）另存一张
+  doc_tags(rowid, key, value) 表，Chroma 的 where 条件翻译成 SQL（where_to_sql），和 MATCH 在同一条查询里过滤、
+  一次 LIMIT 取够；翻译不了的操作符才退回 Python 逐条求值（matches_where），两边过滤语义一致
+'''
+import json
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+# 关键词索引文件
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", "./lexical_index.sqlite")
+# 一次查询最多用多少个词（超长问题截断，免得 MATCH 表达式太大）
+MAX_QUERY_TOKENS = 64
+# where 翻译不成 SQL 时，每次从 FTS 取多少条再在 Python 里过滤
+PAGE_SIZE = 200
+# 索引结构版本（PRAGMA user_version）：1 = 有 doc_tags 表
+SCHEMA_VERSION = 1
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[._\-][a-z0-9]+)*|[㐀-䶿一-鿿]+")
+
+def tokenize(text):
+    '''
+    切词：英文小写按词，中文连续片段切成相邻两字（只有一个字就保留单字）
+    '''
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = []
+    for piece in _TOKEN_RE.findall(text):
+        if piece.isascii() or len(piece) == 1:
+            tokens.append(piece)
+        else:
+            tokens.extend(piece[i:i + 2] for i in range(len(piece) - 1))
+    return tokens
+
+def _compare(op, value, operand):
+    if op == "$eq":
+        return value == operand
+    if op == "$ne":
+        return value != operand
+    if op == "$in":
+        return value in operand
+    if op == "$nin":
+        return value not in operand
+    if value is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        if op == "$lte":
+            return value <= operand
+    except TypeError:
+        return False
+    raise ValueError(f"不支持的过滤操作符: {op}")
+
+def matches_where(metadata, where):
+    '''
+    按 Chroma 的 where 语法判断一条 metadata 是否满足过滤条件
+    支持 $and / $or 以及 $eq $ne $gt $gte $lt $lte $in $nin，直接写值等价于 $eq
+    '''
+    if not where:
+        return True
+    metadata = metadata or {}
+    for key, cond in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, c) for c in cond):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, c) for c in cond):
+                return False
+        elif isinstance(cond, dict):
+            if not all(_compare(op, metadata.get(key), operand) for op, operand in cond.items()):
+                return False
+        elif metadata.get(key) != cond:
+            return False
+    return True
+
+_SQL_OPS = {"$eq": "=", "$ne": "=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<=", "$in": "IN", "$nin": "IN"}
+
+def _tag_rows(rowid, metadata):
+    # 只存标量（Chroma 的 metadata 本来也只有标量）
+    return [
+        (rowid, key, value) for key, value in (metadata or {}).items()
+        if isinstance(value, (str, int, float, bool))
+    ]
+
+def where_to_sql(where):
+    '''
+    把 Chroma 的 where 条件翻译成针对 docs d 的 SQL 条件，返回 (sql, params)
+    每个字段条件变成 doc_tags 上的 EXISTS / NOT EXISTS 子查询；和 matches_where 一样，
+    $ne / $nin 对没有这个字段的文档也算满足
+    遇到不认识的操作符抛 ValueError，调用方退回 Python 过滤
+    '''
+    clauses = []
+    params = []
+    for key, cond in where.items():
+        if key in ("$and", "$or"):
+            parts = [where_to_sql(c) for c in cond]
+            if not parts:
+                continue
+            joiner = " AND " if key == "$and" else " OR "
+            clauses.append("(" + joiner.join(sql for sql, _ in parts) + ")")
+            for _, sub_params in parts:
+                params.extend(sub_params)
+            continue
+        ops = cond.items() if isinstance(cond, dict) else [("$eq", cond)]
+        for op, operand in ops:
+            if op not in _SQL_OPS:
+                raise ValueError(f"不支持的过滤操作符: {op}")
+            if op in ("$in", "$nin"):
+                operand = list(operand)
+                test = f"t.value IN ({', '.join('?' * len(operand))})" if operand else "0"
+            else:
+                operand = [operand]
+                test = f"t.value {_SQL_OPS[op]} ?"
+            negate = "NOT " if op in ("$ne", "$nin") else ""
+            clauses.append(
+                f"{negate}EXISTS (SELECT 1 FROM doc_tags t WHERE t.rowid = d.rowid AND t.key = ? AND {test})"
+            )
+            params.append(key)
+            params.extend(operand)
+    return (" AND ".join(clauses) or "1"), params
+
+class LexicalIndex:
+    def __init__(self,path=LEXICAL_INDEX_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            "rowid INTEGER PRIMARY KEY, collection TEXT NOT NULL, doc_id TEXT NOT NULL, "
+            "document TEXT, metadata TEXT, UNIQUE (collection, doc_id))"
+        )
+        self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(tokens, tokenize='unicode61')")
+        # 可过滤的 metadata 字段；(key, value) 索引给按条件找文档用，主键给按文档查条件用
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS doc_tags ("
+            "rowid INTEGER NOT NULL, key TEXT NOT NULL, value, PRIMARY KEY (rowid, key))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_doc_tags_key_value ON doc_tags (key, value)")
+        self._db.commit()
+        self._migrate()
+
+    def _migrate(self):
+        '''
+        老索引没有 doc_tags：按 docs 里存的 metadata JSON 补一遍（只在第一次打开时发生）
+        '''
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        with self._lock:
+            rows = self._db.execute("SELECT rowid, metadata FROM docs").fetchall()
+            self._db.execute("DELETE FROM doc_tags")
+            for rowid, meta_json in rows:
+                self._db.executemany(
+                    "INSERT INTO doc_tags (rowid, key, value) VALUES (?, ?, ?)",
+                    _tag_rows(rowid, json.loads(meta_json or "{}"))
+                )
+            self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._db.commit()
+        if rows:
+            print(f"[关键词索引] 已给 {len(rows)} 条文档补上过滤字段")
+
+    def _set_tags(self,rowid,metadata):
+        self._db.execute("DELETE FROM doc_tags WHERE rowid = ?", (rowid,))
+        self._db.executemany("INSERT INTO doc_tags (rowid, key, value) VALUES (?, ?, ?)", _tag_rows(rowid, metadata))
+
+    def upsert(self,collection,ids,documents,metadatas):
+        '''
+        和 Chroma 的 upsert 一一对应：同一集合里同一个 id 覆盖旧内容
+        '''
+        with self._lock:
+            for doc_id, doc, meta in zip(ids, documents, metadatas):
+                meta_json = json.dumps(meta or {}, ensure_ascii=False)
+                row = self._db.execute(
+                    "SELECT rowid FROM docs WHERE collection = ? AND doc_id = ?", (collection, doc_id)
+                ).fetchone()
+                if row:
+                    rowid = row[0]
+                    self._db.execute("UPDATE docs SET document = ?, metadata = ? WHERE rowid = ?", (doc, meta_json, rowid))
+                    self._db.execute("DELETE FROM docs_fts WHERE rowid = ?", (rowid,))
+                else:
+                    rowid = self._db.execute(
+                        "INSERT INTO docs (collection, doc_id, document, metadata) VALUES (?, ?, ?, ?)",
+                        (collection, doc_id, doc, meta_json)
+                    ).lastrowid
+                self._db.execute("INSERT INTO docs_fts (rowid, tokens) VALUES (?, ?)", (rowid, " ".join(tokenize(doc))))
+                self._set_tags(rowid, meta)
+            self._db.commit()
+
+    def update_metadata(self,collection,ids,metadatas):
+        with self._lock:
+            for doc_id, meta in zip(ids, metadatas):
+                row = self._db.execute(
+                    "SELECT rowid FROM docs WHERE collection = ? AND doc_id = ?", (collection, doc_id)
+                ).fetchone()
+                if not row:
+                    continue
+                self._db.execute("UPDATE docs SET metadata = ? WHERE rowid = ?", (json.dumps(meta or {}, ensure_ascii=False), row[0]))
+                self._set_tags(row[0], meta)
+            self._db.commit()
+
+    def clear(self,collection):
+        '''
+        删除整个集合的索引（集合被删除重建时用）
+        '''
+        with self._lock:
+            for table in ("docs_fts", "doc_tags"):
+                self._db.execute(
+                    f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM docs WHERE collection = ?)", (collection,)
+                )
+            self._db.execute("DELETE FROM docs WHERE collection = ?", (collection,))
+            self._db.commit()
+
+    def search(self,collection,query_text,n_results=10,where=None):
+        '''
+        BM25 检索，返回 [{'id','content','metadata','bm25'}]，越靠前越相关
+        '''
+        tokens = list(dict.fromkeys(tokenize(query_text)))[:MAX_QUERY_TOKENS]
+        if not tokens:
+            return []
+        # 每个词加引号当作短语，词之间 OR：命中的词越多、越稀有，bm25 越靠前
+        match = " OR ".join('"' + t.replace('"', '""') + '"' for t in tokens)
+        # where 能翻译成 SQL 时一条查询取够；否则分页取出来在 Python 里过滤
+        where_sql, where_params = "1", []
+        python_where = None
+        if where:
+            try:
+                where_sql, where_params = where_to_sql(where)
+            except ValueError:
+                python_where = where
+        hits = []
+        offset = 0
+        with self._lock:
+            while len(hits) < n_results:
+                limit = PAGE_SIZE if python_where else n_results
+                rows = self._db.execute(
+                    "SELECT d.doc_id, d.document, d.metadata, bm25(docs_fts) AS score "
+                    "FROM docs_fts JOIN docs d ON d.rowid = docs_fts.rowid "
+                    f"WHERE docs_fts MATCH ? AND d.collection = ? AND {where_sql} "
+                    "ORDER BY score LIMIT ? OFFSET ?",
+                    (match, collection, *where_params, limit, offset)
+                ).fetchall()
+                for doc_id, doc, meta_json, score in rows:
+                    meta = json.loads(meta_json or "{}")
+                    if matches_where(meta, python_where):
+                        hits.append({'id': doc_id, 'content': doc, 'metadata': meta, 'bm25': score})
+                if len(rows) < limit:
+                    break
+                offset += limit
+        return hits[:n_results]
@@ -0,0 +1,102 @@
+'''
+此代码为统一的异步 LLM 网关，所有 DeepSeek 调用都从这里走
+- 整个进程共用一个 AsyncOpenAI 客户端（底层 httpx 连接池 + keep-alive）
+- 每次调用都有独立超时
+- 用信号量限制同时在飞的请求数，避免把上游打爆
+测试时把 DEEPSEEK_BASE_URL 指向 stub_llm_server.py 即可离线压测
+'''
+import asyncio
+import os
+import httpx
+import openai
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 可以通过环境变量切到本地 stub 服务器
+BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+DEFAULT_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+# 单次调用超时（秒）
+DEFAULT_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+# 同时在飞的 LLM 请求上限
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+_client = None
+_semaphore = None
+
+def get_client():
+    '''
+    懒加载共享客户端（第一次调用时才建连接池）
+    '''
+    global _client
+    if _client is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MAX_CONCURRENCY,
+                max_keepalive_connections=MAX_CONCURRENCY,
+                keepalive_expiry=30
+            ),
+            timeout=DEFAULT_TIMEOUT
+        )
+        _client = openai.AsyncOpenAI(
+            api_key=os.getenv("DEEPSEEK_API_KEY") or "stub-key", # 本地 stub 不校验 key
+            base_url=BASE_URL,
+            http_client=http_client,
+            max_retries=1
+        )
+    return _client
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    return _semaphore
+
+async def chat_completion(messages, model=None, timeout=None, **kwargs):
+    '''
+    发起一次非流式对话，直接返回文本内容
+    messages:OpenAI 格式的消息列表
+    timeout:本次调用的超时（秒），默认 LLM_TIMEOUT
+    '''
+    async with _get_semaphore():
+        response = await get_client().chat.completions.create(
+            model=model or DEFAULT_MODEL,
+            messages=messages,
+            stream=False,
+            timeout=timeout or DEFAULT_TIMEOUT,
+            **kwargs
+        )
+    return response.choices[0].message.content
+
+async def stream_chat_completion(messages, model=None, timeout=None, **kwargs):
+    '''
+    发起一次流式对话（异步生成器），上游每吐出一段文本就产出一段
+    整个流式期间都占着一个并发名额
+    '''
+    async with _get_semaphore():
+        response = await get_client().chat.completions.create(
+            model=model or DEFAULT_MODEL,
+            messages=messages,
+            stream=True,
+            timeout=timeout or DEFAULT_TIMEOUT,
+            **kwargs
+        )
+        try:
+            async for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        finally:
+            await response.close()
+
+async def aclose():
+    '''
+    关闭连接池（应用退出时调用）
+    '''
+    global _client, _semaphore
+    if _client is not None:
+        await _client.close()
+    _client = None
+    _semaphore = None
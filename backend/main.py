@@ -4,14 +4,46 @@
 from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form
 from sqlalchemy.orm import Session
 import models, schemas, crud, services
-from database import engine, get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import engine, async_engine, get_db, get_async_db, migrate
 from fastapi.middleware.cors import CORSMiddleware
 import sleep as memory_sleep
-from typing import List
+import llm_gateway
+import pdf_ingest
+import jobs
+import prompt_builder
+from message_writer import message_writer
+from response_cache import response_cache
+from typing import List, Optional
+from contextlib import asynccontextmanager
+from fastapi.responses import StreamingResponse
+import json
+from vector_memory import get_memory_core, warm_up_in_background
+import os
 
 models.Base.metadata.create_all(bind=engine)
+migrate()
 
-app = FastAPI(title="Research Engram V1 API")
+# 启动时是否在后台预热嵌入模型（关掉则第一次检索时才加载）
+VECTOR_WARMUP = os.getenv("VECTOR_WARMUP", "1") == "1"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # --- 启动：拉起后台解析任务队列，后台预热嵌入模型 ---
+    await jobs.ingest_queue.start()
+    if VECTOR_WARMUP:
+        warm_up_in_background()
+    yield
+    # --- 关闭：停掉任务队列，写完攒着的聊天消息，释放 LLM 连接池和数据库连接池 ---
+    await jobs.ingest_queue.stop()
+    await memory_sleep.sleep_tasks.stop()
+    await message_writer.stop()
+    await llm_gateway.aclose()
+    pdf_ingest.shutdown_executor()
+    await async_engine.dispose()
+
+app = FastAPI(title="Research Engram V1 API", lifespan=lifespan)
 
 # --- 暂时允许跨域请求 (CORS) ---
 app.add_middleware(
@@ -22,6 +54,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def sse_response(events):
+    '''
+    把 services 产出的 (event, data) 事件流包装成 SSE 响应
+    '''
+    async def body():
+        try:
+            async for event, data in events:
+                yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)}, ensure_ascii=False)}\n\n"
+    # X-Accel-Buffering: 让 nginx 之类的反向代理别攒着不发
+    return StreamingResponse(body(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # --- 接口: 注册用户 (使用 CRUD) ---
 @app.post("/users/", response_model=schemas.UserResponse) # r_m 输出前过滤
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
@@ -32,66 +77,100 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
 
 # --- 接口: 上传论文 (PDF) ---
 # 注意：这里用到了 "依赖注入" (Depends) 和 "异步" (async)
+# 文件落盘后立刻返回 job_id，解析/摘要/入库在后台任务队列里完成
 @app.post("/upload_paper/")
 async def upload_paper( # 异步函数
     user_id: int = Form(...),    # 从表单获取 user_id
     idea_id: int = Form(...),    # 从表单获取 idea_id
-    file: UploadFile = File(...), # 获取文件
-    db: Session = Depends(get_db) # 获取数据库连接
+    file: UploadFile = File(...) # 获取文件
 ):
     try:
-        # 服务员(Main) 直接把活儿交给 厨师长(Service)
-        # 这里的 await 意思是：厨师长你去处理吧，处理完了告诉我，我去招呼别的客人
-        db_paper = await services.process_paper_upload(user_id, idea_id, file, db)
-        return {"status": "success", "paper_id": db_paper.id, "title": db_paper.title}
+        job = await jobs.ingest_queue.submit(user_id, idea_id, file)
+        return {"status": "queued", "job_id": job.id, "title": job.filename}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- 接口: 查询后台解析任务状态 ---
+@app.get("/jobs/{job_id}", response_model=schemas.JobResponse)
+async def get_job_status(job_id: str, db: AsyncSession = Depends(get_async_db)):
+    job = await crud.get_ingest_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
 # --- 接口：论文列表 ---
 
 @app.get("/ideas/{idea_id}/papers/", response_model=List[schemas.PaperResponse])
-def get_idea_papers(idea_id: int, db: Session = Depends(get_db)):
-    return db.query(models.Paper).filter(models.Paper.idea_id == idea_id).all()
+async def get_idea_papers(idea_id: int, db: AsyncSession = Depends(get_async_db)):
+    # 列表只需要这几列，不碰全文
+    result = await db.execute(select(
+        models.Paper.id, models.Paper.title, models.Paper.abstract, models.Paper.idea_id
+    ).where(models.Paper.idea_id == idea_id))
+    return result.all()
     
 # --- 接口： 智能对话 ---
 # 前端对话框接这个
+# 数据库会话由 services 自己按需短暂开关，调 LLM 期间不占连接
 @app.post("/chat/", response_model=schemas.ChatResponse)
-async def chat_endpoint(
-    request: schemas.ChatRequest, 
-    db: Session = Depends(get_db)
-):
+async def chat_endpoint(request: schemas.ChatRequest):
     try:
 
-        return await services.chat_with_deepseek(db, request)
+        return await services.chat_with_deepseek(request)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# 流式版本 (SSE)：检索完成、调用工具、每段回答文本都会实时推给前端
+# 事件: retrieval / tool_call / token / done（出错时是 error）
+@app.post("/chat/stream/")
+async def chat_stream_endpoint(request: schemas.ChatRequest):
+    return sse_response(services.chat_events(request))
+
 # 前端的“一键深度评审”
 @app.post("/agent/critique/")
 async def critique_endpoint(
     user_id: int = Form(...),
     query: str = Form(...), 
-    idea_id: int = Form(...),
-    db: Session = Depends(get_db)
+    idea_id: int = Form(...)
 ):
     try:
         # 这里依然调用你原来的那个复杂的 Agent 逻辑
-        critique_content = await services.critical_agent_chat(db, user_id, query, idea_id)
-        # 注意：Agent 返回的是纯文本，不是 ChatResponse 对象，前端要注意区分
-        return {"response": critique_content}
+        # 注意：Agent 返回的是 {"response": 纯文本, "cached": ...}，不是 ChatResponse 对象，前端要注意区分
+        return await services.critical_agent_chat(user_id, query, idea_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# 流式版本 (SSE)，事件: retrieval / tool_call / conflicts / token / done（出错时是 error）
+@app.post("/agent/critique/stream/")
+async def critique_stream_endpoint(
+    user_id: int = Form(...),
+    query: str = Form(...), 
+    idea_id: int = Form(...)
+):
+    return sse_response(services.critique_events(user_id, query, idea_id))
+
 # --- 接口: 获取用户的所有 Idea ---
 @app.get("/users/{user_id}/ideas/")
-def get_user_ideas(user_id: int, db: Session = Depends(get_db)):
-    return db.query(models.Idea).filter(models.Idea.user_id == user_id).all()
+async def get_user_ideas(user_id: int, db: AsyncSession = Depends(get_async_db)):
+    return (await db.scalars(select(models.Idea).where(models.Idea.user_id == user_id))).all()
 
 # --- 接口: 获取某个 Idea 的历史聊天记录 ---
 @app.get("/ideas/{idea_id}/messages/")
-def get_idea_messages(idea_id: int, db: Session = Depends(get_db)):
+async def get_idea_messages(idea_id: int, db: AsyncSession = Depends(get_async_db)):
     # 按时间正序排列，方便前端直接显示
-    return db.query(models.Message).filter(models.Message.idea_id == idea_id).order_by(models.Message.created_at.asc()).all()
+    return (await db.scalars(
+        select(models.Message).where(models.Message.idea_id == idea_id).order_by(models.Message.created_at.asc())
+    )).all()
+
+# --- 接口: 分页获取某个 Idea 的聊天记录（从最新往前翻）---
+# 第一页不传 cursor；往上翻时把上一页返回的 next_cursor 带回来
+@app.get("/ideas/{idea_id}/messages/page/", response_model=schemas.MessagePage)
+async def get_idea_messages_page(idea_id: int, limit: int = 50, cursor: Optional[str] = None, db: AsyncSession = Depends(get_async_db)):
+    limit = max(1, min(limit, 200))
+    try:
+        messages, next_cursor = await crud.get_idea_messages_page(db, idea_id, limit=limit, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="cursor 格式不对")
+    return {"messages": messages, "next_cursor": next_cursor}
 
 # --- 接口: 创建新 Idea ---
 @app.post("/ideas/")
@@ -112,30 +191,47 @@ def update_idea_endpoint(
     updated_idea = crud.update_idea_content(db, idea_id, new_desc)
     if not updated_idea:
         raise HTTPException(status_code=404, detail="Idea 不存在")
+    response_cache.invalidate(idea_id=idea_id)
         
     return {"status": "success", "id": updated_idea.id, "new_description": updated_idea.description}
 
 # --- 接口: 手动触发 sleep ---
+# 后台执行，立刻返回 task_id；同一个用户重复点击会拿到同一个任务
 @app.post("/system/sleep/")
-def trigger_sleep_endpoint(
+async def trigger_sleep_endpoint(
     user_id: int = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # 1. 找用户
-    user = crud.get_user(db, user_id)
+    user = await db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="用户不存在")
-    
-    try:
-        # 2. 调用 sleep.py 里的逻辑
-        # 注意：process_one_user 函数没有返回值，它是直接打印和改数据库
-        # 我们可以稍微修改 sleep.py 让它返回统计信息，或者直接运行
-        memory_sleep.process_one_user(db, user)
-        
-        return {
-            "status": "success", 
-            "message": "大脑整理完成！画像已更新，新知识已固化。",
-            "new_persona": user.persona # 把更新后的画像返给前端看看
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+
+    # 2. 交给 sleep.py 的后台任务管理器
+    progress, deduplicated = memory_sleep.sleep_tasks.submit(user_id)
+    return {
+        "status": progress["status"],
+        "task_id": progress["task_id"],
+        "deduplicated": deduplicated, # True 表示已有整理任务在跑，这次没有新开
+        "message": "大脑整理已在后台进行，可通过 /system/sleep/{task_id} 查看进度。"
+    }
+
+# --- 接口: 查询 sleep 进度 ---
+@app.get("/system/sleep/{task_id}", response_model=schemas.SleepTaskResponse)
+def get_sleep_status(task_id: str):
+    progress = memory_sleep.sleep_tasks.get(task_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return progress
+
+# --- 接口: 查看运行时统计 (缓存命中率等) ---
+@app.get("/system/stats/")
+def get_system_stats():
+    memory_core = get_memory_core()
+    return {
+        "embedding_cache": memory_core.query_cache.stats(),
+        "embedding_store": memory_core.embedding_store.stats(),
+        "prompt": prompt_builder.stats(),
+        "messages": message_writer.stats,
+        "response_cache": response_cache.stats()
+    }
@@ -0,0 +1,136 @@
+'''
+此代码负责把聊天消息写进 SQL
+一轮对话（用户提问 + AI 回答）在回答生成完之后用一个事务一起写入，每轮只提交一次
+打开 MESSAGE_WRITE_BEHIND 后进一步合并：多个请求的对话先攒在内存里，攒够 MESSAGE_FLUSH_SIZE 轮
+或者等满 MESSAGE_FLUSH_INTERVAL 秒就一起写一次（一个事务、一次落盘），高并发时大幅减少提交次数
+- 请求会等到自己那一批真正提交后才返回，拿到的 message_id 是真实的，服务退出前会把剩下的写完
+- 还没写进库的对话可以通过 pending_messages 查到，拼历史时合并进去，连续提问不会丢上一轮
+'''
+import asyncio
+import datetime
+import os
+import crud
+from database import SessionLocal
+
+# 是否跨请求合并写入（0 = 每轮对话单独一个事务）
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "0") == "1"
+# 合并写入时最多等多少秒
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.05"))
+# 攒够多少轮对话立刻写
+MESSAGE_FLUSH_SIZE = int(os.getenv("MESSAGE_FLUSH_SIZE", "64"))
+
+class MessageWriter:
+    def __init__(self,write_behind=MESSAGE_WRITE_BEHIND,flush_interval=MESSAGE_FLUSH_INTERVAL,flush_size=MESSAGE_FLUSH_SIZE):
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = [] # 还没开始写的 [(turn, future)]
+        self._flushing = [] # 正在写的批次，写完之前历史查询也要能看到
+        self._timer = None
+        self._tasks = set() # 后台写入任务，留着引用防止被回收
+        self.stats = {"turns": 0, "commits": 0}
+
+    async def save_turn(self,user_id: int,idea_id,query: str,answer: str):
+        '''
+        写入一轮对话，返回 AI 消息的 id
+        '''
+        turn = {"user_id": user_id, "idea_id": idea_id, "query": query, "answer": answer}
+        if not self.write_behind:
+            ids = await asyncio.to_thread(self._write, [turn])
+            self._record(1)
+            return ids[0]
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((turn, future))
+        if len(self._pending) == self.flush_size:
+            self._spawn(self.flush())
+        elif self._timer is None:
+            self._timer = self._spawn(self._flush_later())
+        # shield：请求被取消（比如流式输出时前端断开）也不影响这批写入
+        return await asyncio.shield(future)
+
+    def pending_messages(self,idea_id):
+        '''
+        某个 Idea 下还没写进库的消息，按时间顺序 [(role, content)]
+        '''
+        lines = []
+        for batch in self._flushing + [self._pending]:
+            for turn, _ in batch:
+                if turn["idea_id"] == idea_id:
+                    lines.append(("user", turn["query"]))
+                    lines.append(("ai", turn["answer"]))
+        return lines
+
+    async def flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self._flushing.append(batch)
+        try:
+            ids = await asyncio.to_thread(self._write, [turn for turn, _ in batch])
+        except Exception as e:
+            print(f"[消息写入] {len(batch)} 轮对话写入失败: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._flushing.remove(batch)
+        self._record(len(batch))
+        for (_, future), msg_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(msg_id)
+
+    async def stop(self):
+        '''
+        服务退出前把攒着的都写掉
+        '''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        await self.flush()
+
+    def _record(self,turns):
+        self.stats["turns"] += turns
+        self.stats["commits"] += 1
+
+    def _spawn(self,coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _write(self,turns):
+        '''
+        一个事务写入若干轮对话，返回每轮 AI 消息的 id
+        时间戳取写入的时刻（不是提问的时刻）：睡眠整理按 created_at 取新消息，
+        晚写入的消息如果带着更早的时间，可能落在水位线之前被漏掉
+        '''
+        db = SessionLocal()
+        try:
+            now = datetime.datetime.utcnow()
+            ids = []
+            for i, turn in enumerate(turns):
+                # 同一批里按顺序错开 1 微秒，保证排序稳定、提问在回答前面
+                asked_at = now + datetime.timedelta(microseconds=2 * i)
+                crud.create_message(db, turn["user_id"], turn["idea_id"], "user", turn["query"],
+                                    created_at=asked_at, commit=False)
+                ai_msg = crud.create_message(db, turn["user_id"], turn["idea_id"], "ai", turn["answer"],
+                                             created_at=asked_at + datetime.timedelta(microseconds=1), commit=False)
+                ids.append(ai_msg.id)
+            db.commit()
+            return ids
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+# 全局唯一的消息写入器
+message_writer = MessageWriter()
@@ -1,9 +1,9 @@
 '''
 此程序是用来定义数据库蓝图长什么样的
 '''
-from sqlalchemy import Column, Integer, String, ForeignKey, Text, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Text, DateTime, Index, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 import datetime
 
 #定义数据库模型的基类 python class => SQL
@@ -20,6 +20,7 @@ class User(Base):
     password_hash = Column(String) # 存储加密后的密码
     persona = Column(Text,default='')
     last_sleep_time = Column(DateTime,default=datetime.datetime(1970, 1, 1))
+    memory_seq = Column(BigInteger,default=0) # 睡眠读到的向量记忆写入序号（检查点），之后写入的论文摘要下次睡眠作为参考
 
     ideas = relationship("Idea", back_populates="owner")
     papers = relationship("Paper", back_populates="uploader")
@@ -48,14 +49,45 @@ class Paper(Base):
     idea_id = Column(Integer, ForeignKey("ideas.id")) # 这篇论文关联到了哪个 Idea
     user_id = Column(Integer, ForeignKey("users.id"))
 
-    #保存Paper全文
-    full_text = Column(Text, nullable=True)
+    #保存Paper全文（按内容去重后，新上传的全文只存在 paper_contents 里）
+    #deferred：查论文列表、取标题摘要时不读这个大字段，真正访问 paper.full_text 时才单独查一次
+    full_text = deferred(Column(Text, nullable=True))
+    #PDF 文件的 sha256，同一份 PDF 不论上传到哪个 Idea 都指向同一条 PaperContent
+    content_hash = Column(String, nullable=True, index=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
     #关联到Idea和User，back_populates表示建立双向关系
     idea = relationship("Idea",back_populates="papers")
     uploader = relationship('User',back_populates='papers')
 
+class PaperContent(Base):
+    __tablename__ = "paper_contents"
+
+    # 按 PDF 内容去重：解析出的全文、deepseek 的结构化分析、向量 id 都只存一份
+    content_hash = Column(String, primary_key=True) # PDF 文件的 sha256
+    # 全文都是延迟加载的：新数据 zlib 压缩后存在 full_text_z，老数据是未压缩的 full_text
+    # 读全文请用 crud.get_paper_full_text / crud.get_content_full_text
+    full_text = deferred(Column(Text, nullable=True))
+    full_text_z = deferred(Column(LargeBinary, nullable=True))
+    summary = Column(Text)
+    claims = Column(Text, default="[]") # JSON 列表
+    critiques = Column(Text, default="[]") # JSON 列表
+    vector_ids = Column(Text, default="[]") # 写进 memory_core 集合的向量 id (JSON 列表)
+    # 第一次上传时的那篇论文，全文切块挂在它名下
+    canonical_paper_id = Column(Integer, ForeignKey("papers.id"), nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class Knowledge(Base):
+    __tablename__ = "knowledge"
+
+    # 睡眠整理出来的隐式知识：向量库里存一份用于检索，这里存一份原文，重建向量库时用
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    content = Column(Text) # 存进向量库的原文（带【睡眠整理知识】前缀）
+    tags = Column(Text, default="[]") # JSON 列表
+    memory_id = Column(String, unique=True, index=True) # 向量库里的 id
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
 class Message(Base):
     __tablename__ = "messages"
 
@@ -66,4 +98,56 @@ class Message(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     idea_id = Column(Integer, ForeignKey("ideas.id"), nullable=True) # 可以为空（闲聊模式）
 
-    idea = relationship("Idea", back_populates="messages")
\ No newline at end of file
+    idea = relationship("Idea", back_populates="messages")
+
+    # 复合索引：按 Idea 翻聊天记录、按用户取睡眠以来的新消息，都是 "等值过滤 + 按时间排序"
+    # SQLite 的二级索引末尾自带 rowid(=id)，(created_at, id) 游标分页也能直接走索引，不用额外排序
+    __table_args__ = (
+        Index("ix_messages_idea_created", "idea_id", "created_at"),
+        Index("ix_messages_user_created", "user_id", "created_at"),
+    )
+
+class IngestJob(Base):
+    __tablename__ = "ingest_jobs"
+
+    # 后台论文解析任务，存在 SQL 里，服务重启后没跑完的任务会被重新捡起来
+    id = Column(String, primary_key=True, index=True) # uuid
+    status = Column(String, default="queued", index=True) # queued / running / done / failed
+    user_id = Column(Integer, ForeignKey("users.id"))
+    idea_id = Column(Integer, ForeignKey("ideas.id"))
+    filename = Column(String)
+    file_path = Column(String) # 上传文件落盘的位置，解析成功后删除
+    attempts = Column(Integer, default=0) # 已经尝试了几次
+    error = Column(Text, nullable=True)
+    paper_id = Column(Integer, ForeignKey("papers.id"), nullable=True) # 成功后对应的论文
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class SleepCycle(Base):
+    __tablename__ = "sleep_cycles"
+
+    # 一次全量睡眠周期（记录用）；finished_at 为空说明被打断了，下次启动时会被关掉
+    id = Column(Integer, primary_key=True, index=True)
+    started_at = Column(DateTime, default=datetime.datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+class SleepCheckpoint(Base):
+    __tablename__ = "sleep_checkpoints"
+
+    # 每个用户在某次睡眠周期里的处理结果（要不要整理只看 users.last_sleep_time 水位线）
+    cycle_id = Column(Integer, ForeignKey("sleep_cycles.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    status = Column(String, default="done") # done / partial（部分窗口失败，记进 sleep_retries） / failed
+    messages = Column(Integer, default=0) # 本次整理了多少条对话
+    error = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class SleepRetry(Base):
+    __tablename__ = "sleep_retries"
+
+    # 睡眠里整理失败的窗口的消息：水位线照常前进，下次睡眠只对这些消息重做失败的那一步
+    # task: knowledge（知识提取失败）/ persona（画像更新失败），成功的那一步不会重做
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), primary_key=True)
+    task = Column(String, primary_key=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
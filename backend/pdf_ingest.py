@@ -0,0 +1,143 @@
+'''
+此代码负责 PDF 的读取与解析，全程不阻塞事件循环
+1. 上传的文件按块写进临时文件（不一次性读进内存）
+2. pypdf 解析是 CPU 密集的，按页分批丢进进程池并行解析
+3. 每一页解析完就按顺序交给切块器，同时记录每页耗时
+'''
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import UploadFile
+from pypdf import PdfReader
+import chunker
+
+# 最多解析多少页，0 表示不限制
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "0"))
+# 解析进程数
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 每个进程任务一次解析几页（太小了进程间开销大，太大了并行度低）
+PDF_PAGE_BATCH = int(os.getenv("PDF_PAGE_BATCH", "4"))
+# 上传文件每次读多少字节
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # 用 spawn 而不是 fork：主进程里有模型和线程，fork 出来不安全
+        _executor = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+
+async def spool_upload(file: UploadFile, directory=None):
+    '''
+    把上传的文件分块写到磁盘，返回 (文件路径, 字节数)
+    directory:写到哪个目录，默认系统临时目录
+    '''
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=directory)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                data = await file.read(UPLOAD_CHUNK_BYTES)
+                if not data:
+                    break
+                await asyncio.to_thread(f.write, data)
+                size += len(data)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, size
+
+def file_sha256(path):
+    '''
+    计算文件内容的 sha256（分块读，不占内存）
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _count_pages(path):
+    return len(PdfReader(path).pages)
+
+def _extract_pages(path, start, end):
+    '''
+    在子进程里解析 [start, end) 页，返回 [(页码, 文本, 耗时秒)]
+    '''
+    reader = PdfReader(path)
+    pages = []
+    for i in range(start, end):
+        t0 = time.perf_counter()
+        text = reader.pages[i].extract_text() or ""
+        pages.append((i, text, time.perf_counter() - t0))
+    return pages
+
+async def iter_pdf_pages(path, max_pages=None):
+    '''
+    按页码顺序异步产出 (页码, 文本, 耗时秒)
+    所有批次一开始就全部提交给进程池，后面的页在前面的页被消费时已经在并行解析了
+    '''
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    num_pages = await loop.run_in_executor(executor, _count_pages, path)
+    if max_pages:
+        num_pages = min(num_pages, max_pages)
+
+    futures = [
+        loop.run_in_executor(executor, _extract_pages, path, start, min(start + PDF_PAGE_BATCH, num_pages))
+        for start in range(0, num_pages, PDF_PAGE_BATCH)
+    ]
+    try:
+        for fut in futures:
+            for page in await fut:
+                yield page
+    finally:
+        for fut in futures:
+            fut.cancel()
+
+async def extract_pdf(path, max_pages=None):
+    '''
+    解析整份 PDF，边解析边切块
+    max_pages:最多解析几页，默认读 PDF_MAX_PAGES（0 为不限制）
+    返回 {"full_text", "chunks", "page_timings", "num_pages", "seconds"}
+    '''
+    if max_pages is None:
+        max_pages = PDF_MAX_PAGES
+    t0 = time.perf_counter()
+    paper_chunker = chunker.PaperChunker()
+    texts = []
+    chunks = []
+    page_timings = []
+    async for page_no, text, seconds in iter_pdf_pages(path, max_pages=max_pages):
+        page_timings.append({"page": page_no + 1, "seconds": round(seconds, 4), "chars": len(text)})
+        if text:
+            texts.append(text)
+            chunks.extend(paper_chunker.feed(text + "\n"))
+    chunks.extend(paper_chunker.finish())
+
+    elapsed = time.perf_counter() - t0
+    if page_timings:
+        slowest = max(page_timings, key=lambda p: p["seconds"])
+        print(f"PDF 解析完成：{len(page_timings)} 页，用时 {elapsed:.2f}s，最慢第 {slowest['page']} 页 {slowest['seconds']:.2f}s")
+    return {
+        "full_text": "\n".join(texts),
+        "chunks": chunks,
+        "page_timings": page_timings,
+        "num_pages": len(page_timings),
+        "seconds": round(elapsed, 4)
+    }
@@ -0,0 +1,146 @@
+'''
+此代码负责按 token 预算拼 prompt
+一次请求的 prompt 由几段组成：系统指令、用户画像、对话历史、检索片段、论文内容……
+总预算有限时按优先级分配：
+1. 先给每段保底（min_tokens）
+2. 再按优先级从高到低装各段，每段最多用掉池子里剩下的预算，装完没用上的留给后面的段
+超出分配的部分：普通文本在句子边界截断；检索片段整条丢弃（从排在后面的开始）；对话历史丢最早的
+每次拼完都会记下各段用了多少 token，方便看延迟和花费花在哪里
+'''
+import os
+import threading
+import token_budget
+
+# 一次对话请求 prompt 的总 token 预算
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+
+# 进程内的累计统计（/system/stats/ 里看）
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "tokens": 0, "truncated": 0, "sections": {}}
+
+class PromptBuilder:
+    '''
+    用法：
+        builder = PromptBuilder()
+        builder.add_text("instructions", 指令, priority=0)
+        builder.add_items("rag", 检索片段列表, priority=2)
+        builder.add_history("history", 历史消息列表, priority=3)
+        parts = builder.build()   # {"instructions": ..., "rag": ..., "history": ...}
+        builder.breakdown         # 各段 token 用量
+    priority 越小越重要
+    '''
+    def __init__(self,budget=PROMPT_TOKEN_BUDGET,name="chat"):
+        self.budget = budget
+        self.name = name
+        self.sections = []
+        self.breakdown = None
+
+    def add_text(self,name,text,priority,min_tokens=0):
+        '''
+        普通文本：预算不够时在句子边界截断
+        '''
+        self._add(name, "text", [text or ""], priority, min_tokens, "")
+
+    def add_items(self,name,items,priority,min_tokens=0,separator="\n"):
+        '''
+        一条条的片段（检索结果）：预算不够时从后往前整条丢弃
+        '''
+        self._add(name, "items", [i for i in items if i], priority, min_tokens, separator)
+
+    def add_history(self,name,messages,priority,min_tokens=0,separator="\n"):
+        '''
+        对话历史（按时间从早到晚）：预算不够时先丢最早的
+        '''
+        self._add(name, "history", [m for m in messages if m], priority, min_tokens, separator)
+
+    def _add(self,name,kind,pieces,priority,min_tokens,separator):
+        self.sections.append({
+            "name": name,
+            "kind": kind,
+            "pieces": pieces,
+            "priority": priority,
+            "min_tokens": min_tokens,
+            "separator": separator,
+            "requested": token_budget.estimate_tokens(separator.join(pieces))
+        })
+
+    def build(self):
+        '''
+        分配预算并返回 {段名: 截好的文本}
+        '''
+        order = sorted(self.sections, key=lambda s: s["priority"])
+
+        # 1. 保底
+        reserved = {}
+        pool = self.budget
+        for s in order:
+            reserved[s["name"]] = min(s["min_tokens"], s["requested"], pool)
+            pool -= reserved[s["name"]]
+
+        # 2. 按优先级依次装：每段能用 自己的保底 + 池子里剩下的，没用完的留给后面的段
+        parts = {}
+        breakdown = {"budget": self.budget, "total": 0, "sections": {}}
+        for s in order:
+            text = self._fit(s, reserved[s["name"]] + pool)
+            tokens = token_budget.estimate_tokens(text)
+            pool += reserved[s["name"]] - tokens
+            parts[s["name"]] = text
+            breakdown["total"] += tokens
+            breakdown["sections"][s["name"]] = {
+                "tokens": tokens,
+                "requested": s["requested"],
+                "truncated": tokens < s["requested"]
+            }
+        self.breakdown = breakdown
+        self._record(breakdown)
+        return parts
+
+    @staticmethod
+    def _fit(section,max_tokens):
+        pieces = section["pieces"]
+        separator = section["separator"]
+        if section["requested"] <= max_tokens:
+            return separator.join(pieces)
+        if section["kind"] == "text":
+            return token_budget.truncate_to_tokens(pieces[0], max_tokens)
+
+        # 片段按原顺序保留前面的；历史倒过来保留最近的
+        ordered = list(reversed(pieces)) if section["kind"] == "history" else pieces
+        kept = []
+        used = 0
+        for piece in ordered:
+            cost = token_budget.estimate_tokens(piece) + (token_budget.estimate_tokens(separator) if kept else 0)
+            if used + cost > max_tokens:
+                break
+            kept.append(piece)
+            used += cost
+        if not kept and ordered:
+            # 一条都放不下时，截断最重要的那一条
+            kept = [token_budget.truncate_to_tokens(ordered[0], max_tokens)]
+        if section["kind"] == "history":
+            kept.reverse()
+        return separator.join(k for k in kept if k)
+
+    def _record(self,breakdown):
+        truncated = [name for name, s in breakdown["sections"].items() if s["truncated"]]
+        summary = " ".join(f"{name}={s['tokens']}" for name, s in breakdown["sections"].items())
+        print(f"[Prompt:{self.name}] {breakdown['total']}/{breakdown['budget']} tokens ({summary})"
+              + (f"，截断: {','.join(truncated)}" if truncated else ""))
+        with _stats_lock:
+            _stats["requests"] += 1
+            _stats["tokens"] += breakdown["total"]
+            _stats["truncated"] += 1 if truncated else 0
+            for name, s in breakdown["sections"].items():
+                _stats["sections"][name] = _stats["sections"].get(name, 0) + s["tokens"]
+
+def stats():
+    with _stats_lock:
+        requests = _stats["requests"]
+        return {
+            "requests": requests,
+            "avg_tokens": _stats["tokens"] / requests if requests else 0.0,
+            "truncated_requests": _stats["truncated"],
+            "avg_section_tokens": {
+                name: tokens / requests for name, tokens in _stats["sections"].items()
+            } if requests else {}
+        }
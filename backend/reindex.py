@@ -0,0 +1,222 @@
+'''
+此代码用于从 SQL 重建向量库（改了集合结构、换集合名、Chroma 数据坏了都可以用）
+数据来源：
+- 论文摘要 / 批驳：paper_contents（去重后的论文）+ papers（老数据只有摘要）
+- 论文全文切块：paper_contents 的全文（压缩的 full_text_z 或老的 full_text）/ papers.full_text，重新切块
+- 睡眠知识：knowledge 表
+关键词索引（lexical_index）跟着一起重建，老数据第一次用混合检索前跑一次本脚本即可
+向量优先从磁盘向量缓存（embedding_store）读，只有缓存里没有的文本才跑模型，重建主要是 I/O
+用法：
+    python reindex.py                         # 原地补齐 memory_core / paper_chunks
+    python reindex.py --drop                  # 先删掉集合再完整重建
+    python reindex.py --collection memory_v2  # 重建到新集合
+    python reindex.py --seed                  # 先把现有集合里的向量灌进缓存（缓存还是空的时候用）
+'''
+import argparse
+import datetime
+import json
+import time
+import models
+import crud
+import chunker
+from sqlalchemy.orm import undefer
+from database import SessionLocal, engine, migrate
+from vector_memory import VectorMemory
+
+# 每批写入多少条
+BATCH_SIZE = 256
+
+def _timestamp(dt):
+    dt = dt or datetime.datetime(1970, 1, 1)
+    return dt.strftime("%Y-%m-%d %H:%M:%S"), dt.timestamp()
+
+def _flush(memory, batch):
+    if batch["texts"]:
+        memory.add_memories(batch["texts"], metadatas=batch["metadatas"], ids=batch["ids"])
+    count = len(batch["texts"])
+    batch.update({"texts": [], "metadatas": [], "ids": []})
+    return count
+
+def _add(memory, batch, text, metadata, mem_id):
+    batch["texts"].append(text)
+    batch["metadatas"].append(metadata)
+    batch["ids"].append(mem_id)
+    if len(batch["texts"]) >= BATCH_SIZE:
+        return _flush(memory, batch)
+    return 0
+
+def seed_store(memory, page_size=500):
+    '''
+    把现有集合里已经算好的向量写进磁盘缓存（同一个模型算的，直接复用）
+    '''
+    seeded = 0
+    for collection in (memory.collection, memory.chunk_collection):
+        offset = 0
+        while True:
+            page = collection.get(limit=page_size, offset=offset, include=['documents', 'embeddings'])
+            if not page["ids"]:
+                break
+            memory.embedding_store.put_many(page["documents"], page["embeddings"])
+            seeded += len(page["ids"])
+            if len(page["ids"]) < page_size:
+                break
+            offset += page_size
+    print(f"[缓存] 从现有集合灌入 {seeded} 条向量")
+
+def backfill_knowledge(db, memory, page_size=500):
+    '''
+    knowledge 表是后来加的，之前睡眠整理的知识只在向量库里：删集合之前先抄一份到 SQL
+    '''
+    known = {mem_id for (mem_id,) in db.query(models.Knowledge.memory_id)}
+    added = 0
+    offset = 0
+    while True:
+        page = memory.collection.get(
+            where={"role": "implicit_knowledge"},
+            limit=page_size,
+            offset=offset,
+            include=['documents', 'metadatas']
+        )
+        if not page["ids"]:
+            break
+        for mem_id, doc, meta in zip(page["ids"], page["documents"], page["metadatas"]):
+            if mem_id in known:
+                continue
+            known.add(mem_id)
+            meta = meta or {}
+            created_at = datetime.datetime.fromtimestamp(meta["ts"]) if meta.get("ts") else None
+            db.add(models.Knowledge(user_id=meta.get("user_id"), content=doc, memory_id=mem_id, created_at=created_at))
+            added += 1
+        if len(page["ids"]) < page_size:
+            break
+        offset += page_size
+    db.commit()
+    if added:
+        print(f"[知识] 从向量库补录 {added} 条睡眠知识到 knowledge 表")
+
+def reindex_papers(db, memory, batch):
+    '''
+    论文摘要和批驳，格式与 services.ingest_paper_file 写入的一致
+    '''
+    count = 0
+    papers_by_hash = {}
+    for paper in db.query(models.Paper).order_by(models.Paper.id.asc()):
+        papers_by_hash.setdefault(paper.content_hash, []).append(paper)
+
+    # 1. 去重后的论文：向量挂在第一次上传的那篇论文下，其他 Idea 用 in_idea_x 标记
+    contents = {c.content_hash: c for c in db.query(models.PaperContent)}
+    for content_hash, content in contents.items():
+        papers = papers_by_hash.get(content_hash, [])
+        canonical = next((p for p in papers if p.id == content.canonical_paper_id), papers[0] if papers else None)
+        if canonical is None:
+            continue
+        timestamp, ts = _timestamp(canonical.created_at)
+        base = {
+            "user_id": canonical.user_id,
+            "idea_id": canonical.idea_id,
+            "paper_db_id": canonical.id,
+            "timestamp": timestamp,
+            "ts": ts
+        }
+        for p in papers:
+            if p.idea_id != canonical.idea_id:
+                base[f"in_idea_{p.idea_id}"] = True
+        count += _add(memory, batch, f'论文标题：{canonical.title}\nAI摘要:{content.summary}\n',
+                      dict(base, role="paper_summary"), f"paper_{canonical.id}")
+        critiques = json.loads(content.critiques or "[]")
+        if critiques:
+            count += _add(memory, batch, f"论文标题：{canonical.title}\n局限与反思：{'; '.join(critiques)}",
+                          dict(base, role="paper_critique"), f"paper_{canonical.id}_critique")
+
+    # 2. 去重之前的老论文：SQL 里只有摘要（批驳当时只写进了向量库）
+    for paper in papers_by_hash.get(None, []):
+        timestamp, ts = _timestamp(paper.created_at)
+        count += _add(memory, batch, f'论文标题：{paper.title}\nAI摘要:{paper.abstract}\n', {
+            "role": "paper_summary",
+            "user_id": paper.user_id,
+            "idea_id": paper.idea_id,
+            "paper_db_id": paper.id,
+            "timestamp": timestamp,
+            "ts": ts
+        }, f"paper_{paper.id}")
+    return count
+
+def reindex_knowledge(db, memory, batch):
+    count = 0
+    for k in db.query(models.Knowledge).order_by(models.Knowledge.id.asc()):
+        timestamp, ts = _timestamp(k.created_at)
+        count += _add(memory, batch, k.content, {
+            "user_id": k.user_id,
+            "role": "implicit_knowledge",
+            "source": "sleep_consolidation",
+            "timestamp": timestamp,
+            "ts": ts
+        }, k.memory_id)
+    return count
+
+def reindex_chunks(db, memory):
+    '''
+    全文重新切块入库（切块参数改了也能用这个刷新）
+    '''
+    count = 0
+    owners = []
+    # 全文列是延迟加载的，这里要逐条用，一次性查出来
+    for content in db.query(models.PaperContent).options(undefer(models.PaperContent.full_text), undefer(models.PaperContent.full_text_z)):
+        full_text = crud.get_content_full_text(content)
+        if full_text and content.canonical_paper_id:
+            owners.append((content.canonical_paper_id, full_text))
+    for paper in db.query(models.Paper).options(undefer(models.Paper.full_text)).filter(
+        models.Paper.content_hash.is_(None), models.Paper.full_text.isnot(None)
+    ):
+        owners.append((paper.id, paper.full_text))
+
+    for paper_id, full_text in owners:
+        paper = db.query(models.Paper).filter(models.Paper.id == paper_id).first()
+        if paper is None:
+            continue
+        chunks = chunker.chunk_text(full_text)
+        memory.index_paper_chunks(paper.id, chunks, {"user_id": paper.user_id, "idea_id": paper.idea_id})
+        count += len(chunks)
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="从 SQL 重建向量库")
+    parser.add_argument("--collection", default="memory_core", help="记忆集合名")
+    parser.add_argument("--chunk-collection", default="paper_chunks", help="全文切块集合名")
+    parser.add_argument("--drop", action="store_true", help="先删掉集合再重建")
+    parser.add_argument("--seed", action="store_true", help="先把现有集合里的向量灌进磁盘缓存")
+    parser.add_argument("--skip-chunks", action="store_true", help="不重建全文切块")
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+    migrate()
+    t0 = time.perf_counter()
+    memory = VectorMemory(collection_name=args.collection, chunk_collection_name=args.chunk_collection)
+    db = SessionLocal()
+    try:
+        backfill_knowledge(db, memory)
+        # 老记忆补上写入序号，睡眠才能按序号增量读到它们
+        memory.backfill_sequence()
+        if args.seed:
+            seed_store(memory)
+        if args.drop:
+            print(f"[重建] 删除集合 {args.collection} / {args.chunk_collection}")
+            for name in (args.collection, args.chunk_collection):
+                memory.client.delete_collection(name)
+                memory.lexical_index.clear(name)
+            memory = VectorMemory(collection_name=args.collection, chunk_collection_name=args.chunk_collection)
+
+        batch = {"texts": [], "metadatas": [], "ids": []}
+        papers = reindex_papers(db, memory, batch)
+        knowledge = reindex_knowledge(db, memory, batch)
+        written = papers + knowledge + _flush(memory, batch)
+        chunks = 0 if args.skip_chunks else reindex_chunks(db, memory)
+    finally:
+        db.close()
+
+    stats = memory.embedding_store.stats()
+    print(f"✅ 重建完成：{written} 条记忆，{chunks} 个全文切块，用时 {time.perf_counter() - t0:.1f}s")
+    print(f"   向量缓存命中 {stats['hits']} 条，重新编码 {stats['misses']} 条")
+
+if __name__ == "__main__":
+    main()
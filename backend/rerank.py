@@ -0,0 +1,96 @@
+'''
+此代码是检索之后的重排阶段：先多取一些候选，再挑出最好的几条放进 prompt
+- 相关性：默认用问题向量和文档向量的余弦（文档向量基本都在磁盘缓存里，不用再跑模型）
+  配置了 RERANK_CROSS_ENCODER 时改用本地的小交叉编码器在 CPU 上打分（更准，慢一些）
+- 多样性：MMR，避免几条说的差不多的片段一起挤进 prompt
+- 预算：按 token 预算往里装，装不下的跳过
+'''
+import os
+import threading
+import numpy as np
+import token_budget
+
+# 重排前先取多少条候选
+RERANK_FETCH_K = int(os.getenv("RERANK_FETCH_K", "30"))
+# MMR 里相关性的权重（1 = 只看相关性，越小越看重多样性）
+RERANK_MMR_LAMBDA = float(os.getenv("RERANK_MMR_LAMBDA", "0.7"))
+# 检索结果放进 prompt 的默认 token 预算
+RERANK_TOKEN_BUDGET = int(os.getenv("RERANK_TOKEN_BUDGET", "1200"))
+# 交叉编码器模型（本地路径或模型名），留空则不用
+RERANK_CROSS_ENCODER = os.getenv("RERANK_CROSS_ENCODER", "")
+
+_cross_encoder = None
+_cross_encoder_lock = threading.Lock()
+
+def get_cross_encoder():
+    global _cross_encoder
+    if _cross_encoder is None:
+        with _cross_encoder_lock:
+            if _cross_encoder is None:
+                from sentence_transformers import CrossEncoder
+                print(f"[Rerank] 正在加载交叉编码器: {RERANK_CROSS_ENCODER}")
+                _cross_encoder = CrossEncoder(RERANK_CROSS_ENCODER, device="cpu")
+    return _cross_encoder
+
+def _min_max(scores):
+    scores = np.asarray(scores, dtype=np.float32)
+    span = scores.max() - scores.min()
+    if span < 1e-9:
+        return np.ones_like(scores)
+    return (scores - scores.min()) / span
+
+def relevance_scores(query_text, query_vector, doc_texts, doc_vectors):
+    '''
+    每个候选和问题的相关性，归一化到 [0, 1]
+    '''
+    if RERANK_CROSS_ENCODER:
+        scores = get_cross_encoder().predict([(query_text, doc) for doc in doc_texts])
+    else:
+        # 模型输出是归一化的，点积就是余弦
+        scores = doc_vectors @ query_vector
+    return _min_max(scores)
+
+def mmr(relevance, doc_vectors, lambda_=RERANK_MMR_LAMBDA):
+    '''
+    最大边际相关（MMR）：每次挑 "相关性高、且和已选的不太像" 的那一条，返回全部候选的挑选顺序
+    '''
+    order = []
+    remaining = list(range(len(relevance)))
+    similarity = doc_vectors @ doc_vectors.T
+    while remaining:
+        if order:
+            redundancy = similarity[np.ix_(remaining, order)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining), dtype=np.float32)
+        scores = lambda_ * relevance[remaining] - (1 - lambda_) * redundancy
+        best = remaining[int(np.argmax(scores))]
+        order.append(best)
+        remaining.remove(best)
+    return order
+
+def rerank(query_text, query_vector, candidates, doc_vectors, k=3, max_tokens=None):
+    '''
+    对检索候选重排，按 MMR 顺序装进 token 预算，最多 k 条
+    candidates:检索结果 [{'content','metadata',...}]
+    doc_vectors:与 candidates 一一对应的文档向量
+    '''
+    if not candidates:
+        return []
+    max_tokens = RERANK_TOKEN_BUDGET if max_tokens is None else max_tokens
+    doc_vectors = np.asarray(doc_vectors, dtype=np.float32)
+    query_vector = np.asarray(query_vector, dtype=np.float32)
+    relevance = relevance_scores(query_text, query_vector, [c['content'] for c in candidates], doc_vectors)
+
+    selected = []
+    used = 0
+    for i in mmr(relevance, doc_vectors):
+        tokens = token_budget.estimate_tokens(candidates[i]['content'])
+        if used + tokens > max_tokens:
+            continue
+        hit = dict(candidates[i])
+        hit['relevance'] = float(relevance[i])
+        selected.append(hit)
+        used += tokens
+        if len(selected) >= k:
+            break
+    return selected
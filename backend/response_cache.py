@@ -0,0 +1,138 @@
+'''
+此代码是对话回答的语义缓存：同一个范围里问了几乎一样的问题，直接返回上次的回答，不再走检索和 LLM
+- 范围(scope) = (接口, 用户, Idea, 论文, 模式, 上下文指纹)，只在同一个范围里比较
+  上下文指纹由调用方给出：用户画像、最近一次睡眠的水位线、Agent 模式下的对话历史……任何一个变了都不会命中
+- 匹配：问题向量（和检索共用查询向量缓存，不多跑模型）余弦相似度 >= RESPONSE_CACHE_THRESHOLD
+- 失效：Idea 描述修改、Idea 下新增论文、睡眠写入新知识时调用 invalidate，把相关范围的条目删掉并提升版本号
+  全局检索（没选 Idea / 开了全局搜索 / 深度评审）的条目任何一次失效都会一起删掉
+- 过期：每条最多活 RESPONSE_CACHE_TTL 秒；条目数超过 RESPONSE_CACHE_ENTRIES 时淘汰最久没用的
+'''
+import hashlib
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+# 是否开启回答缓存（默认关：开了之后 "重新问一遍" 会拿到同一个回答）
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+# 问题向量相似度达到多少才算同一个问题
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+# 每条缓存的存活秒数
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+# 最多缓存多少条回答
+RESPONSE_CACHE_ENTRIES = int(os.getenv("RESPONSE_CACHE_ENTRIES", "2048"))
+
+def fingerprint(*parts):
+    '''
+    把影响回答的上下文压成一个短哈希
+    '''
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(repr(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+class ResponseCache:
+    def __init__(self,max_entries=RESPONSE_CACHE_ENTRIES,ttl=RESPONSE_CACHE_TTL,threshold=RESPONSE_CACHE_THRESHOLD,enabled=RESPONSE_CACHE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.enabled = enabled
+        self._entries = OrderedDict() # entry_id -> {"scope", "vector", "value", "expires_at"}，按最近使用排序
+        self._by_scope = {} # scope -> {entry_id}
+        self._versions = {} # ("idea", id) / ("user", id) -> 版本号
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def scope(self,kind,user_id,idea_id=None,paper_id=None,mode="",is_global=False,context=""):
+        '''
+        生成缓存范围；带上 Idea 和用户当前的版本号，失效之后旧条目自然对不上
+        '''
+        with self._lock:
+            idea_version = self._versions.get(("idea", idea_id), 0)
+            user_version = self._versions.get(("user", user_id), 0)
+        return (kind, user_id, idea_id, paper_id, mode, bool(is_global), context, idea_version, user_version)
+
+    def lookup(self,scope,vector):
+        '''
+        在同一个范围里找最相似的问题，返回 (缓存的回答, 相似度)，没命中返回 (None, 最高相似度)
+        '''
+        if not self.enabled:
+            return None, 0.0
+        vector = np.asarray(vector, dtype=np.float32)
+        now = time.monotonic()
+        best_id, best_score = None, -1.0
+        with self._lock:
+            for entry_id in list(self._by_scope.get(scope, ())):
+                entry = self._entries[entry_id]
+                if entry["expires_at"] <= now:
+                    self._remove(entry_id)
+                    continue
+                score = float(entry["vector"] @ vector)
+                if score > best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None or best_score < self.threshold:
+                self.misses += 1
+                return None, max(best_score, 0.0)
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return dict(self._entries[best_id]["value"]), best_score
+
+    def store(self,scope,vector,value):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = {
+                "scope": scope,
+                "vector": np.asarray(vector, dtype=np.float32),
+                "value": dict(value),
+                "expires_at": time.monotonic() + self.ttl
+            }
+            self._by_scope.setdefault(scope, set()).add(entry_id)
+            # 淘汰最久没用的
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self,user_id=None,idea_id=None):
+        '''
+        某个 Idea 或某个用户的数据变了：提升版本号，删掉受影响的条目
+        '''
+        with self._lock:
+            if idea_id is not None:
+                self._versions[("idea", idea_id)] = self._versions.get(("idea", idea_id), 0) + 1
+            if user_id is not None:
+                self._versions[("user", user_id)] = self._versions.get(("user", user_id), 0) + 1
+            stale = [
+                s for s in self._by_scope
+                if s[5] or (idea_id is not None and s[2] == idea_id) or (user_id is not None and s[1] == user_id)
+            ]
+            for s in stale:
+                for entry_id in list(self._by_scope.get(s, ())):
+                    self._remove(entry_id)
+
+    def _remove(self,entry_id):
+        entry = self._entries.pop(entry_id)
+        ids = self._by_scope.get(entry["scope"])
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_scope[entry["scope"]]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+# 全局唯一的回答缓存
+response_cache = ResponseCache()
@@ -4,7 +4,7 @@
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
-from typing import List, Optional, Literal
+from typing import List, Optional, Literal, Dict, Any
 
 # --- 基础模型 (Base) ---
 # 这些是 Idea 共有的一些属性
@@ -50,6 +50,7 @@ class PaperCreate(BaseModel):
     abstract: str
     idea_id: int # 必须指定属于哪个 Idea
     full_text: Optional[str] = None
+    content_hash: Optional[str] = None # PDF 内容哈希，用于跨 Idea 复用解析结果
 
 class PaperResponse(BaseModel):
     id: int
@@ -84,4 +85,52 @@ class ChatResponse(BaseModel):
     response_text: str # AI的回答
     suggested_idea: Optional[str] = None # 是否通过新idea，可为空值
     used_references: List[str] = [] # 本次对话引用的知识，必须是列表
-    message_id: int # 对话id
\ No newline at end of file
+    message_id: int # 对话id
+    prompt_tokens: Dict[str, Any] = {} # 本次各次 LLM 调用的 prompt token 用量（按段拆分）
+    cached: bool = False # True = 命中了回答缓存，没有重新检索和调用 LLM
+
+# 聊天记录里的一条消息
+class MessageResponse(BaseModel):
+    id: int
+    content: str
+    role: str # "user" / "ai"
+    created_at: datetime
+    user_id: int
+    idea_id: Optional[int] = None
+
+    class Config:
+        from_attributes = True
+
+# 分页的聊天记录：messages 按时间正序，next_cursor 传回来取更早的一页，为空说明到头了
+class MessagePage(BaseModel):
+    messages: List[MessageResponse]
+    next_cursor: Optional[str] = None
+
+# 后台解析任务的状态：前端轮询 /jobs/{job_id} 用
+class JobResponse(BaseModel):
+    id: str
+    status: str # queued / running / done / failed
+    filename: Optional[str] = None
+    attempts: int = 0
+    error: Optional[str] = None
+    paper_id: Optional[int] = None
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
+# 手动睡眠任务的进度：前端轮询 /system/sleep/{task_id} 用
+class SleepTaskResponse(BaseModel):
+    task_id: str
+    user_id: int
+    status: str # queued / running / done / failed
+    messages_read: int = 0 # 读了多少条新对话
+    windows_total: int = 0 # 切成了几个整理窗口
+    windows_processed: int = 0 # 已经整理完几个窗口
+    knowledge_written: int = 0 # 写入了几条隐式知识
+    persona_updated: bool = False # 画像是否更新
+    new_persona: Optional[str] = None
+    error: Optional[str] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
@@ -5,33 +5,42 @@
 后续更新计划：加入真正的function calling实现简单的agent任务
 '''
 import os
-from sqlalchemy.orm import Session
-from pypdf import PdfReader
+from sqlalchemy.orm import Session, load_only
+from sqlalchemy.exc import IntegrityError
 from fastapi import UploadFile
 import schemas, crud
-from vector_memory import VectorMemory
+from vector_memory import VectorMemory, get_memory_core
 import datetime
-import openai
-from dotenv import load_dotenv
 import models
 import utils
+import llm_gateway
+from database import SessionLocal
+from message_writer import message_writer
+from response_cache import response_cache, fingerprint
+import token_budget
+from prompt_builder import PromptBuilder
+import chunker
+import pdf_ingest
 import json
 import re
+import asyncio
 
-# 读取 .env
-load_dotenv()
+# 找茬模式下，凑够这么多条高分冲突就不再继续打分
+CRITIQUE_ENOUGH_CONFLICTS = int(os.getenv("CRITIQUE_ENOUGH_CONFLICTS", "3"))
+# 深度阅读模式每轮检索多少个全文片段，以及这些片段合计的 token 上限
+DEEP_READ_TOP_K = int(os.getenv("DEEP_READ_TOP_K", "8"))
+DEEP_READ_TOKEN_BUDGET = int(os.getenv("DEEP_READ_TOKEN_BUDGET", "3000"))
+# 生成摘要时最多发给 deepseek 多少 token 的论文开头
+SUMMARY_INPUT_TOKENS = int(os.getenv("SUMMARY_INPUT_TOKENS", "1500"))
 
-# 初始化 DeepSeek
-client = openai.OpenAI(
-    api_key=os.getenv("DEEPSEEK_API_KEY"), # 从系统环境变量里拿钥匙，而不是写死在代码里
-    base_url="https://api.deepseek.com"
-)
-
-# 初始化向量记忆库（单例模式：整个系统只用这一个实例，避免重复加载模型）
-# 注意：这里我们假设 vector_memory.py 在同一目录下
-memory_core = VectorMemory()
+# 向量记忆库通过 get_memory_core() 获取（全进程共享一个实例，避免重复加载模型）
 
 # ================= 功能A：接收pdf，保存全文，llm提取摘要，存入向量库 =================
+class PaperSummaryError(Exception):
+    """
+    deepseek 没能生成论文摘要（后台任务据此决定要不要重试）
+    """
+
 async def process_paper_upload(
     user_id: int, 
     idea_id: int, 
@@ -44,22 +53,18 @@ async def process_paper_upload(
     
     # 1. 读取 PDF 内容 (I/O 操作)
     # UploadFile 是 FastAPI 的特有类型，类似于一个打开的文件句柄
-    content = await file.read() 
-    
-    # 为了用 pypdf 读取，我们需要把二进制存成临时文件，或者用 BytesIO
-    # 这里为了演示简单，我们假设是一个标准的文本提取流程
-    import io
-    pdf_file = io.BytesIO(content) # 把二进制流变成像文件一样可读的对象
-    reader = PdfReader(pdf_file)
-    
-    full_text = ""
-    for i,page in enumerate(reader.pages):
-        if i >10:break
-        text = page.extract_text()
-        if text:
-            full_text += page.extract_text() + "\n"
-    
-    # 2. 使用deepseek生成摘要
+    # 先分块落盘，再交给 ingest_paper_file 处理
+    pdf_path, _ = await pdf_ingest.spool_upload(file)
+    try:
+        return await ingest_paper_file(user_id, idea_id, pdf_path, file.filename, db)
+    finally:
+        os.remove(pdf_path)
+
+async def summarize_paper(full_text: str, allow_fallback: bool = True):
+    """
+    使用deepseek生成摘要、核心贡献和批驳，返回 (abstract, claims, critiques)
+    allow_fallback:失败时是否退化为截取前500字；为 False 时直接抛 PaperSummaryError
+    """
     print("使用deepseek生成摘要中...")
     structure_prompt = """
     你是一个科研论文分析师。请分析这篇论文，输出纯 JSON 对象：
@@ -69,43 +74,77 @@ async def process_paper_upload(
         "critiques": ["指出的现有方法缺陷", "本论文方法的局限性", "反直觉的实验结果"]
     }
     """
+    claims = []
+    critiques = []
     try:
-        response = client.chat.completions.create(
-            model = 'deepseek-chat',
-            messages=[
-                {'role':'system','content': structure_prompt},
-                {'role':'user','content':full_text[:2000]}# 发送前2000字符，防止超长
-            ],
-            stream=False
-        )
+        content_str = await llm_gateway.chat_completion([
+            {'role':'system','content': structure_prompt},
+            {'role':'user','content':token_budget.truncate_to_tokens(full_text, SUMMARY_INPUT_TOKENS)}# 只发开头，防止超长
+        ])
         # 解析 JSON (增加容错)
-        import json
-        content_str = response.choices[0].message.content.replace("```json", "").replace("```", "").strip()
+        content_str = content_str.replace("```json", "").replace("```", "").strip()
         analysis = json.loads(content_str)
         
         abstract = analysis.get("summary", "摘要生成失败")
+        claims = analysis.get("claims", [])
         critiques = analysis.get("critiques", [])
         if abstract == "摘要生成失败":
             print("deepseek生成摘要失败...")
+            if not allow_fallback:
+                raise PaperSummaryError("deepseek 返回的 JSON 里没有摘要")
         else:
             print("deepseek成功生成摘要！")
 
+    except PaperSummaryError:
+        raise
     except Exception as e:
-        print("deepseek总结失败，采用其他方案：{e}")
+        if not allow_fallback:
+            raise PaperSummaryError(str(e)) from e
+        print(f"deepseek总结失败，采用其他方案：{e}")
         #提取前500字作为摘要
         abstract = full_text[:500] + "..."
 
-    title = file.filename # 暂时用文件名当标题
+    return abstract, claims, critiques
+
+async def ingest_paper_file(
+    user_id: int,
+    idea_id: int,
+    pdf_path: str,
+    filename: str,
+    db: Session,
+    allow_fallback: bool = True
+):
+    """
+    处理已经落盘的 PDF：解析文本 -> 生成摘要 -> 存 SQL -> 存向量库
+    （同步上传和后台任务队列共用这一段）
+    同一份 PDF（按内容哈希判断）只解析、总结、编码一次，之后再上传只新建一条 Paper 关联过去
+    """
+    title = filename # 暂时用文件名当标题
+
+    # 0. 按内容去重
+    content_hash = await asyncio.to_thread(pdf_ingest.file_sha256, pdf_path)
+    # SQL 都放到线程里跑：一次提交可能要等 SQLite 写锁，不能卡住事件循环上的其他请求
+    content = await asyncio.to_thread(crud.get_paper_content, db, content_hash)
+    if content:
+        return await link_existing_paper(db, content, user_id, idea_id, title)
+
+    # 1. 交给进程池按页并行解析，边解析边切块
+    extracted = await pdf_ingest.extract_pdf(pdf_path)
+    full_text = extracted["full_text"]
+
+    # 2. 使用deepseek生成摘要
+    abstract, claims, critiques = await summarize_paper(full_text, allow_fallback=allow_fallback)
 
     # 3. 调用 CRUD 层：存入 SQL 数据库
     # 这一步是为了保证无论向量库挂没挂，我们的基础数据都在
+    # 全文只存在 PaperContent 里，Paper 上只记哈希
     paper_schema = schemas.PaperCreate(
         title=title, 
         abstract=abstract, 
         idea_id=idea_id,
-        full_text=full_text # 传给 schema
+        content_hash=content_hash
     )
-    db_paper = crud.create_paper_record(db=db, paper=paper_schema, user_id=user_id)
+    db_paper = await asyncio.to_thread(crud.create_paper_record, db, paper_schema, user_id)
 
     # 4. 调用 VectorMemory：存入向量数据库
     # 我们把 paper_id 存进去，这样以后检索到向量，能反向查到 SQL 里的完整信息
@@ -127,115 +166,319 @@ async def process_paper_upload(
                 "timestamp": current_time 
     }
     
-    # 构造存入向量库的文本
+    # 构造存入向量库的文本，摘要和批驳一次批量写入
     # ---- 正向存储 把摘要和题目存在一起 ----
-    save_text = f'论文标题：{title}\nAI摘要:{abstract}\n'
-    memory_core.add_memory(
-        text=save_text, 
-        metadata=metadata_true,
-        mem_id=f"paper_{db_paper.id}"
-    )
+    texts = [f'论文标题：{title}\nAI摘要:{abstract}\n']
+    metadatas = [metadata_true]
+    mem_ids = [f"paper_{db_paper.id}"]
 
     # ---- 反向存储 存入批驳 ----
     if critiques:
-        critique_text = f"论文标题：{title}\n局限与反思：{'; '.join(critiques)}"
-        memory_core.add_memory(
-            text=critique_text,
-            metadata=metadata_false
-        )
-
+        texts.append(f"论文标题：{title}\n局限与反思：{'; '.join(critiques)}")
+        metadatas.append(metadata_false)
+        mem_ids.append(f"paper_{db_paper.id}_critique")
+
+    await asyncio.to_thread(get_memory_core().add_memories, texts, metadatas=metadatas, ids=mem_ids)
+
+    # 5. 全文切块入库，深度阅读模式按问题检索相关片段
+    chunks = extracted["chunks"]
+    await asyncio.to_thread(
+        get_memory_core().index_paper_chunks,
+        db_paper.id,
+        chunks,
+        {"user_id": user_id, "idea_id": idea_id}
+    )
+    print(f"全文已切成 {len(chunks)} 块存入！")
+
+    # 6. 记下这份内容的解析结果，下次同样的 PDF 直接复用
+    await asyncio.to_thread(_remember_paper_content, db, db_paper, models.PaperContent(
+        content_hash=content_hash,
+        full_text_z=crud.compress_text(full_text),
+        summary=abstract,
+        claims=json.dumps(claims, ensure_ascii=False),
+        critiques=json.dumps(critiques, ensure_ascii=False),
+        vector_ids=json.dumps(mem_ids),
+        canonical_paper_id=db_paper.id
+    ))
 
     print("论文成功存入！")
+    # 这个 Idea 下多了一篇论文，之前缓存的回答可能没考虑到它
+    response_cache.invalidate(idea_id=idea_id)
 
     return db_paper
 
+def _remember_paper_content(db: Session, db_paper: models.Paper, content: models.PaperContent):
+    """
+    写入 PaperContent（在线程里跑）；提交后 db_paper 的属性会过期，顺手重新读好，回到事件循环上直接用不会再查库
+    """
+    try:
+        crud.create_paper_content(db, content)
+    except IntegrityError:
+        # 同一份 PDF 被并发上传，另一边已经写好了
+        db.rollback()
+    db.refresh(db_paper)
+
+async def link_existing_paper(
+    db: Session,
+    content: models.PaperContent,
+    user_id: int,
+    idea_id: int,
+    title: str
+):
+    """
+    这份 PDF 以前解析过：只新建一条 Paper 指向同一份内容，并把已有向量标记为也属于这个 Idea
+    """
+    print(f"♻️ 论文内容已存在（{content.content_hash[:12]}），直接复用解析结果")
+    paper_schema = schemas.PaperCreate(
+        title=title,
+        abstract=content.summary,
+        idea_id=idea_id,
+        content_hash=content.content_hash
+    )
+    # 提交之后 content 会过期，向量 id 先取出来
+    vector_ids = json.loads(content.vector_ids or "[]")
+    db_paper = await asyncio.to_thread(crud.create_paper_record, db, paper_schema, user_id)
+    await asyncio.to_thread(get_memory_core().add_idea_membership, vector_ids, idea_id)
+    response_cache.invalidate(idea_id=idea_id)
+    return db_paper
+
 # ================= 功能B (重构版)：通用智能对话流水线，含function calling =================
 # services.py
 
-async def chat_with_deepseek(db: Session, request: schemas.ChatRequest):
-    # 1. 存用户消息
-    user_msg = models.Message(content=request.query, role="user", user_id=request.user_id, idea_id=request.idea_id)
-    db.add(user_msg)
-    db.commit()
+TOOL_CALL_TAG = "<TOOL_CALL>"
+
+def detect_tool_call(content: str):
+    """
+    从 Agent 的输出里找 <TOOL_CALL>...</TOOL_CALL>，找到就返回里面的内容，否则返回 None
+    """
+    if not content:
+        return None
+    match = re.search(r"<TOOL_CALL>(.*?)</TOOL_CALL>", content, re.S)
+    return match.group(1).strip() if match else None
+
+def _persona_block(persona: str):
+    """
+    用户画像（睡眠时整理出来的）拼进 system prompt 的那一段，没有就是空
+    """
+    return f"\n【用户画像】:\n{persona}\n" if persona else ""
 
+async def _complete(messages, stream: bool):
+    """
+    调 LLM：流式时逐段产出增量文本，非流式时一次产出完整回答
+    """
+    if stream:
+        async for delta in llm_gateway.stream_chat_completion(messages):
+            yield delta
+    else:
+        yield await llm_gateway.chat_completion(messages)
+
+def _load_chat_context(request: schemas.ChatRequest, pending=()):
+    """
+    第一段（只读）：把后面要用的 SQL 数据一次读出来，然后马上关掉会话
+    后面检索、调 LLM、流式输出期间都不占数据库连接；这一轮的提问和回答最后一起写入（message_writer）
+    pending:这个 Idea 下还在写入队列里、没进库的消息 [(role, content)]
+    """
+    db = SessionLocal()
+    try:
+        user = crud.get_user(db, request.user_id)
+        context = {
+            "persona": user.persona if user else "",
+            # 睡眠水位线：睡眠可能在另一个进程里跑，画像和知识变了靠它让回答缓存失效
+            "sleep_mark": user.last_sleep_time if user else None,
+            "paper": None,
+            "history_lines": []
+        }
+
+        if request.paper_id:
+            # 只取要用的几列，全文到确实需要时再查
+            paper = db.query(models.Paper).options(load_only(
+                models.Paper.id, models.Paper.title, models.Paper.abstract,
+                models.Paper.user_id, models.Paper.idea_id, models.Paper.content_hash
+            )).filter(models.Paper.id == request.paper_id).first()
+            if paper:
+                # 复用的论文，全文块挂在第一次上传的那篇名下
+                chunk_owner_id = paper.id
+                if paper.content_hash:
+                    canonical_paper_id = db.query(models.PaperContent.canonical_paper_id).filter(
+                        models.PaperContent.content_hash == paper.content_hash
+                    ).scalar()
+                    if canonical_paper_id:
+                        chunk_owner_id = canonical_paper_id
+                context["paper"] = {
+                    "id": paper.id,
+                    "title": paper.title,
+                    "abstract": paper.abstract,
+                    "user_id": paper.user_id,
+                    "idea_id": paper.idea_id,
+                    "chunk_owner_id": chunk_owner_id
+                }
+                # 老论文上传时还没切块，第一次深度阅读时补上（全文要趁会话还开着读出来）
+                if request.use_full_text and not get_memory_core().has_paper_chunks(chunk_owner_id):
+                    context["paper"]["full_text"] = crud.get_paper_full_text(db, paper)
+        elif request.idea_id and request.history_len > 0:
+            # 历史记录依然建议只看当前的，否则对话太乱。
+            # 当然，如果你想让“对话历史”也跨 Idea，可以把 filter 去掉。这里暂且保持只看当前 Idea 的历史。
+            last_msgs = db.query(models.Message).filter(models.Message.idea_id == request.idea_id).order_by(models.Message.created_at.desc()).limit(request.history_len).all()
+            last_msgs.reverse()
+            # 库里的 + 还没写进库的 + 这一轮的提问（它要等回答完才和回答一起入库）
+            history = [(m.role, m.content) for m in last_msgs] + list(pending) + [("user", request.query)]
+            context["history_lines"] = [f"{role}: {content}" for role, content in history[-request.history_len:]]
+        return context
+    finally:
+        db.close()
+
+async def chat_events(request: schemas.ChatRequest, stream: bool = True):
+    """
+    对话流水线（异步生成器），按阶段产出事件 (event, data)：
+    - retrieval : 检索完成，data = {"mode", "references"}
+    - tool_call : Agent 决定去查资料，data = {"query"}；之前收到的 token 作废，后面是新的回答
+    - token     : 回答的增量文本，data = {"text"}
+    - done      : 结束，data = ChatResponse 的字段
+    stream=False 时 LLM 不走流式，整段回答作为一个 token 事件产出（/chat/ 用）
+    """
     final_answer = ""
     used_refs = []
+    prompt_tokens = {} # 每次拼 prompt 的 token 用量，随回复一起返回
+
+    context = await asyncio.to_thread(_load_chat_context, request, message_writer.pending_messages(request.idea_id))
+    persona = context["persona"]
+    paper = context["paper"]
 
     # 🟢 预先定义过滤条件 (复用逻辑)
     # 逻辑：只有当 (选了Idea) 且 (没开全局搜索) 时，才限制范围
     # 否则 (没选Idea 或 开了全局) -> filter 为 None (搜全部)
-    current_filter = {"idea_id": request.idea_id} if (request.idea_id and not request.enable_global_search) else None
+    current_filter = VectorMemory.idea_filter(request.idea_id) if (request.idea_id and not request.enable_global_search) else None
     
     # 用于打印日志看看
     mode_name = "🌍 全局联想" if not current_filter else f"🔒 专注当前(ID:{request.idea_id})"
 
+    # 语义缓存：同一个范围里问过几乎一样的问题，直接用上次的回答（检索和 LLM 都省掉）
+    cache_scope = None
+    if response_cache.enabled and (paper or not request.paper_id):
+        chat_mode = ("deep" if request.use_full_text else "summary") if request.paper_id else "agent"
+        cache_scope = response_cache.scope(
+            "chat", request.user_id, request.idea_id, request.paper_id,
+            mode=chat_mode,
+            is_global=chat_mode != "deep" and current_filter is None,
+            # Agent 模式的回答依赖对话历史（最后一行是这次的问题，不算在内）
+            context=fingerprint(persona, context["sleep_mark"], context["history_lines"][:-1] if chat_mode == "agent" else [])
+        )
+        query_vector = (await asyncio.to_thread(get_memory_core().embed_queries, [request.query]))[0]
+        cached, score = response_cache.lookup(cache_scope, query_vector)
+        if cached:
+            print(f"⚡ [回答缓存] 命中，相似度 {score:.3f}")
+            yield "retrieval", {"mode": mode_name, "references": cached["used_references"]}
+            yield "token", {"text": cached["response_text"]}
+            message_id = await message_writer.save_turn(request.user_id, request.idea_id, request.query, cached["response_text"])
+            yield "done", dict(cached, message_id=message_id, prompt_tokens={}, cached=True)
+            return
+
     # ================= 分支一：指定了论文 (Context Locked) =================
     if request.paper_id:
-        paper = db.query(models.Paper).filter(models.Paper.id == request.paper_id).first()
         if not paper:
-            return schemas.ChatResponse(response_text="❌ 找不到指定的论文数据", message_id=0)
+            final_answer = "❌ 找不到指定的论文数据"
+            yield "token", {"text": final_answer}
+            yield "done", {"response_text": final_answer, "suggested_idea": None, "used_references": [], "message_id": 0, "prompt_tokens": {}}
+            return
 
         # --- A. 深度阅读模式 (Full Text) ---
         # 这种模式下，我们要深度读这一篇，通常不需要 RAG 干扰，所以不使用 filter
         if request.use_full_text:
-            print(f"📖 [深度模式] 阅读全文：{paper.title}")
-            if not paper.full_text:
-                return schemas.ChatResponse(response_text="⚠️ 该论文未录入全文数据", message_id=0)
-
+            print(f"📖 [深度模式] 阅读全文：{paper['title']}")
+            chunk_owner_id = paper["chunk_owner_id"]
+
+            if "full_text" in paper:
+                if not paper["full_text"]:
+                    final_answer = "⚠️ 该论文未录入全文数据"
+                    yield "token", {"text": final_answer}
+                    yield "done", {"response_text": final_answer, "suggested_idea": None, "used_references": [], "message_id": 0, "prompt_tokens": {}}
+                    return
+                chunks = chunker.chunk_text(paper["full_text"])
+                await asyncio.to_thread(
+                    get_memory_core().index_paper_chunks,
+                    chunk_owner_id,
+                    chunks,
+                    {"user_id": paper["user_id"], "idea_id": paper["idea_id"]}
+                )
+
+            # 只取和问题最相关的 top-k 片段，而不是把全文塞进 prompt
+            hits = await asyncio.to_thread(
+                get_memory_core().search_paper_chunks,
+                request.query,
+                chunk_owner_id,
+                n_results=DEEP_READ_TOP_K,
+                max_tokens=DEEP_READ_TOKEN_BUDGET
+            )
+            used_refs = [h['content'][:20] for h in hits]
+
+            builder = PromptBuilder(name="deep_read")
+            builder.add_text("query", request.query, priority=0)
+            builder.add_items("paper", [f"[{h['metadata'].get('section', '正文')}]\n{h['content']}" for h in hits], priority=1, separator="\n\n")
+            builder.add_text("persona", persona, priority=3)
+            parts = builder.build()
+            prompt_tokens[builder.name] = builder.breakdown
             system_prompt = f"""
             你是一个专业的论文审稿人。用户指定了一篇论文进行【深度研读】。
-            【标题】: {paper.title}
-            【全文】:
-            {paper.full_text[:35000]} 
-            请基于全文细节回答。
+            【标题】: {paper["title"]}
+            【全文相关片段】:
+            {parts["paper"]} 
+            {_persona_block(parts["persona"])}
+            请基于这些原文细节回答。
             """
-            messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": request.query}]
+            messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": parts["query"]}]
 
         # --- B. 摘要聚焦 + RAG 联想模式 ---
         # 🟢 关键点：这里要用到 current_filter
         else:
-            print(f"🔍 [摘要模式] {mode_name} - 论文：{paper.title}")
+            print(f"🔍 [摘要模式] {mode_name} - 论文：{paper['title']}")
             
             # 1. 基础是摘要
-            base_context = f"【当前讨论论文】\n标题：{paper.title}\n摘要：{paper.abstract}"
             
             # 2. RAG 检索 (这里用到了 filter！)
             # 如果开启全局，这里就能搜到其他 Idea 的相关论文
-            search_results = memory_core.search_memory(
+            # 多取候选再重排，只把最好的几条（不超预算）放进 prompt
+            search_results = await asyncio.to_thread(
+                get_memory_core().retrieve,
                 request.query, 
-                n_results=3, 
+                k=3, 
                 filter_metadata=current_filter # 👈 注入过滤逻辑
             )
-            rag_context = "\n".join([f"- {r['content']}" for r in search_results])
             used_refs = [r['content'][:20] for r in search_results]
 
+            # 3. 按预算拼 prompt：问题 > 摘要 > 关联知识 > 用户画像
+            builder = PromptBuilder(name="summary")
+            builder.add_text("query", request.query, priority=0)
+            builder.add_text("abstract", paper["abstract"], priority=1)
+            builder.add_items("rag", [f"- {r['content']}" for r in search_results], priority=2)
+            builder.add_text("persona", persona, priority=3)
+            parts = builder.build()
+            prompt_tokens[builder.name] = builder.breakdown
             system_prompt = f"""
             你是一个科研助手。
-            {base_context}
+            【当前讨论论文】
+            标题：{paper["title"]}
+            摘要：{parts["abstract"]}
             
             【关联知识 ({mode_name})】:
-            {rag_context}
-            
+            {parts["rag"]}
+            {_persona_block(parts["persona"])}
             请结合摘要和关联知识回答。
             """
-            messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": request.query}]
+            messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": parts["query"]}]
+
+        yield "retrieval", {"mode": mode_name, "references": used_refs}
 
         # 执行 LLM (分支一)
-        response = client.chat.completions.create(model="deepseek-chat", messages=messages, stream=False)
-        final_answer = response.choices[0].message.content
+        async for delta in _complete(messages, stream):
+            final_answer += delta
+            yield "token", {"text": delta}
 
     # ================= 分支二：Agent 自由模式 (无指定 Paper) =================
     else:
         print(f"🤖 [Agent模式] {mode_name}")
         
-        # 1. 历史记录
-        history_context = ""
-        if request.idea_id and request.history_len > 0:
-            # 历史记录依然建议只看当前的，否则对话太乱。
-            # 当然，如果你想让“对话历史”也跨 Idea，可以把 filter 去掉。这里暂且保持只看当前 Idea 的历史。
-            last_msgs = db.query(models.Message).filter(models.Message.idea_id == request.idea_id).order_by(models.Message.created_at.desc()).limit(request.history_len).all()
-            last_msgs.reverse()
-            history_context = "\n".join([f"{m.role}: {m.content}" for m in last_msgs])
+        # 1. 历史记录（已在第一段读出）
+        history_lines = context["history_lines"]
 
         # 2. Agent 思考
         agent_system_prompt = f"""
@@ -245,14 +488,29 @@ async def chat_with_deepseek(db: Session, request: schemas.ChatRequest):
         2. 否则 -> 直接回答。
         """
 
-        resp1 = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": agent_system_prompt},
-                {"role": "user", "content": f"历史:\n{history_context}\n问题:\n{request.query}"}
-            ]
-        )
-        first_content = resp1.choices[0].message.content
+        # 历史按预算保留最近的几条，超长的不会把问题挤掉
+        builder = PromptBuilder(name="agent")
+        builder.add_text("query", request.query, priority=0)
+        builder.add_history("history", history_lines, priority=2)
+        builder.add_text("persona", persona, priority=3)
+        parts = builder.build()
+        prompt_tokens[builder.name] = builder.breakdown
+
+        # 开头可能是 <TOOL_CALL>，先攒着；一旦确定不是，就边收边往外推
+        first_content = ""
+        streaming = False
+        async for delta in _complete([
+            {"role": "system", "content": agent_system_prompt + _persona_block(parts["persona"])},
+            {"role": "user", "content": f"历史:\n{parts['history']}\n问题:\n{parts['query']}"}
+        ], stream):
+            first_content += delta
+            if streaming:
+                yield "token", {"text": delta}
+                continue
+            head = first_content.lstrip()
+            if not (TOOL_CALL_TAG.startswith(head) or head.startswith(TOOL_CALL_TAG)):
+                streaming = True
+                yield "token", {"text": first_content}
         
         # 3. 工具检测与执行
         tool_query = detect_tool_call(first_content)
@@ -260,91 +518,146 @@ async def chat_with_deepseek(db: Session, request: schemas.ChatRequest):
         if tool_query:
             keyword = tool_query.replace("search:", "").strip()
             print(f"🔧 Agent 正在搜索: {keyword} | 模式: {mode_name}")
+            yield "tool_call", {"query": keyword}
             
             # 🟢 关键点：Agent 搜索时也要遵守 filter 规则
-            res = memory_core.search_memory(
+            res = await asyncio.to_thread(
+                get_memory_core().retrieve,
                 keyword, 
-                n_results=3, 
+                k=3, 
                 filter_metadata=current_filter # 👈 注入过滤逻辑
             )
             
-            knowledge = "\n".join([f"- {r['content']}" for r in res])
             used_refs = [r['content'][:20] for r in res]
-            
-            resp2 = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[
-                    {"role": "system", "content": "结合检索结果回答："},
-                    {"role": "user", "content": f"问题:{request.query}\n资料:{knowledge}"}
-                ]
-            )
-            final_answer = resp2.choices[0].message.content
+            yield "retrieval", {"mode": mode_name, "references": used_refs}
+
+            builder = PromptBuilder(name="agent_answer")
+            builder.add_text("query", request.query, priority=0)
+            builder.add_items("rag", [f"- {r['content']}" for r in res], priority=1)
+            parts = builder.build()
+            prompt_tokens[builder.name] = builder.breakdown
+            async for delta in _complete([
+                {"role": "system", "content": "结合检索结果回答："},
+                {"role": "user", "content": f"问题:{parts['query']}\n资料:{parts['rag']}"}
+            ], stream):
+                final_answer += delta
+                yield "token", {"text": delta}
         else:
+            if not streaming and first_content:
+                yield "token", {"text": first_content}
             final_answer = first_content
 
     # ================= 收尾 =================
-    ai_msg = models.Message(content=final_answer, role="ai", user_id=request.user_id, idea_id=request.idea_id)
-    db.add(ai_msg)
-    db.commit()
-
-    return schemas.ChatResponse(
-        response_text=final_answer,
-        suggested_idea=None,
-        used_references=used_refs,
-        message_id=ai_msg.id
-    )
+    # 提问和回答一个事务写入
+    message_id = await message_writer.save_turn(request.user_id, request.idea_id, request.query, final_answer)
+
+    result = {"response_text": final_answer, "suggested_idea": None, "used_references": used_refs}
+    if cache_scope is not None and final_answer:
+        response_cache.store(cache_scope, query_vector, result)
+
+    yield "done", dict(result, message_id=message_id, prompt_tokens=prompt_tokens, cached=False)
+
+async def chat_with_deepseek(request: schemas.ChatRequest):
+    """
+    非流式对话：跑完整条流水线，返回 ChatResponse
+    """
+    async for event, data in chat_events(request, stream=False):
+        if event == "done":
+            return schemas.ChatResponse(**data)
 
 # ================= 功能C：进行对抗性检索（深度评判） =================  
-async def critical_agent_chat(
-    db: Session,
+def _load_sleep_state(user_id: int):
+    """
+    读用户的画像和睡眠水位线（回答缓存的上下文指纹用），短会话读完就关
+    """
+    db = SessionLocal()
+    try:
+        user = crud.get_user(db, user_id)
+        if not user:
+            return "", None
+        return user.persona, user.last_sleep_time
+    finally:
+        db.close()
+
+async def critique_events(
     user_id: int,
     query: str,
-    idea_id: int = None
+    idea_id: int = None,
+    stream: bool = True
 ):
     """
-    正向检索 + 反向攻击 + 逻辑打分。
+    正向检索 + 反向攻击 + 逻辑打分（异步生成器），按阶段产出事件 (event, data)：
+    - retrieval : 正向检索完成，data = {"references"}
+    - tool_call : 反向关键词检索，data = {"keywords"}
+    - conflicts : 冲突打分完成，data = {"conflicts"}
+    - token     : 回答的增量文本，data = {"text"}
+    - done      : 结束，data = {"response", "cached"}
     """
-    
-    # 1. 基础上下文检索 (正向)
-    support_results = memory_core.search_memory(query, n_results=3)
-    support_text = "\n".join([f"- {r['content']}" for r in support_results])
-
-    # 2. 对抗性检索 (反向)
+    # 语义缓存：评审检索的是整个向量库，算全局条目，任何 Idea / 知识变化都会让它失效
+    # 睡眠在另一个进程里跑时收不到 invalidate，靠画像和睡眠水位线的指纹让旧条目对不上
+    cache_scope = None
+    if response_cache.enabled:
+        persona, sleep_mark = await asyncio.to_thread(_load_sleep_state, user_id)
+        cache_scope = response_cache.scope(
+            "critique", user_id, idea_id, is_global=True,
+            context=fingerprint(persona, sleep_mark, [])
+        )
+        query_vector = (await asyncio.to_thread(get_memory_core().embed_queries, [query]))[0]
+        cached, score = response_cache.lookup(cache_scope, query_vector)
+        if cached:
+            print(f"⚡ [回答缓存] 评审命中，相似度 {score:.3f}")
+            yield "token", {"text": cached["response"]}
+            yield "done", {"response": cached["response"], "cached": True}
+            return
+
+    # 1. 正向检索 和 反向关键词生成 同时进行（一个是本地向量库，一个是 LLM 调用）
     print("正在进行批判性思考...")
-    # 生成反向关键词
-    bad_keywords = utils.generate_adversarial_keywords(query)
-    
+    support_results, bad_keywords = await asyncio.gather(
+        asyncio.to_thread(get_memory_core().retrieve, query, k=3),
+        utils.generate_adversarial_keywords(query)
+    )
+    yield "retrieval", {"references": [r['content'][:20] for r in support_results]}
+
+    # 2. 对抗性检索 (反向)：所有反向关键词一次批量检索
+    if not isinstance(bad_keywords, list):
+        bad_keywords = [str(bad_keywords)]
+    yield "tool_call", {"keywords": [str(kw) for kw in bad_keywords]}
+    keyword_results = await asyncio.to_thread(
+        get_memory_core().search_many, [str(kw) for kw in bad_keywords], n_results=2
+    )
+
+    # 不同关键词经常命中同一条证据，去重后再打分
     critique_evidences = []
-    # 去向量库里专门搜 role='paper_critique' 的数据
-    # 注意：这里假设 vector_memory.search_memory 以后可以支持 filter 参数
-    # 目前先简单搜全文
-    for kw in bad_keywords:
-        res = memory_core.search_memory(kw, n_results=2)
-        critique_evidences.extend(res)
-
-    # 3. 逻辑冲突量化 (The Metric)
-    high_conflict_points = []
-    for evi in critique_evidences:
-        # 调用 utils 里的量化器
-        assessment = utils.calculate_conflict_score(query, evi['content'])
-        
-        if assessment['score'] >= 6: # 只有冲突分大于6的才值得报告
-            high_conflict_points.append({
-                "content": evi['content'],
-                "score": assessment['score'],
-                "reason": assessment['reason']
-            })
-
-    # 4. 组装最终 Agent Prompt
+    seen_content = set()
+    for res in keyword_results:
+        for evi in res:
+            if evi['content'] in seen_content:
+                continue
+            seen_content.add(evi['content'])
+            critique_evidences.append(evi['content'])
+
+    # 3. 逻辑冲突量化 (The Metric)：并发打分，凑够高分冲突就提前收工
+    # 只有冲突分大于等于6的才值得报告
+    high_conflict_points = await utils.calculate_conflict_scores(
+        query, critique_evidences, min_score=6, enough=CRITIQUE_ENOUGH_CONFLICTS
+    )
+    yield "conflicts", {"conflicts": high_conflict_points}
+
+    # 4. 组装最终 Agent Prompt：想法 > 冲突点（已按分数排好） > 支持证据
+    builder = PromptBuilder(name="critique")
+    builder.add_text("query", query, priority=0)
+    builder.add_items("conflicts", [json.dumps(p, ensure_ascii=False) for p in high_conflict_points], priority=1)
+    builder.add_items("support", [f"- {r['content']}" for r in support_results], priority=2)
+    parts = builder.build()
     system_prompt = f"""
     你是一个不仅提供帮助，更提供“深度洞察”的科研伙伴。
-    用户正在思考："{query}"
+    用户正在思考："{parts["query"]}"
     
     【已有支持证据】:
-    {support_text}
+    {parts["support"]}
     
     【⚠️ 潜在的逻辑风险 (基于现有论文的反驳)】:
-    {json.dumps(high_conflict_points, ensure_ascii=False)}
+    {parts["conflicts"]}
     
     请回复用户：
     1. 首先肯定 Idea 的价值（如果有支持证据）。
@@ -353,13 +666,25 @@ async def critical_agent_chat(
     """
 
     # 5. 生成最终回复
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[{"role": "system", "content": system_prompt}],
-        stream=False
-    )
-    
-    return response.choices[0].message.content
+    response = ""
+    async for delta in _complete([{"role": "system", "content": system_prompt}], stream):
+        response += delta
+        yield "token", {"text": delta}
+    if cache_scope is not None and response:
+        response_cache.store(cache_scope, query_vector, {"response": response})
+    yield "done", {"response": response, "cached": False}
+
+async def critical_agent_chat(
+    user_id: int,
+    query: str,
+    idea_id: int = None
+):
+    """
+    非流式的深度评审，返回 {"response": 回答文本, "cached": 是否来自缓存}
+    """
+    async for event, data in critique_events(user_id, query, idea_id, stream=False):
+        if event == "done":
+            return data
 
 
 
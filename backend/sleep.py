@@ -1,45 +1,150 @@
 '''
 此代码用于生成用户画像,并提取对话内容，作为知识
 '''
-import time
+import asyncio
 import json
 import os
+import uuid
 import datetime
+from sqlalchemy import func, and_
 from sqlalchemy.orm import Session
-from database import SessionLocal
-import models
-from vector_memory import VectorMemory
-import openai
-from dotenv import load_dotenv
+from database import SessionLocal, engine, migrate
+import models, crud
+from vector_memory import get_memory_core
+from response_cache import response_cache
+import llm_gateway
+import token_budget
+import numpy as np
 
-# 加载环境变量
-load_dotenv()
+# 睡眠周期里同时整理几个用户
+SLEEP_WORKERS = int(os.getenv("SLEEP_WORKERS", "8"))
+# 每个整理窗口最多放多少 token 的对话
+SLEEP_WINDOW_TOKENS = int(os.getenv("SLEEP_WINDOW_TOKENS", "6000"))
+# 两条知识的余弦相似度超过这个值就算重复
+SLEEP_DEDUP_THRESHOLD = float(os.getenv("SLEEP_DEDUP_THRESHOLD", "0.92"))
+# 读新对话时每批取多少条
+SLEEP_FETCH_SIZE = int(os.getenv("SLEEP_FETCH_SIZE", "500"))
+# 整理时附带的新论文摘要最多多少 token
+SLEEP_REFERENCE_TOKENS = int(os.getenv("SLEEP_REFERENCE_TOKENS", "1000"))
 
-# 初始化 DeepSeek 客户端
-client = openai.OpenAI(
-    api_key=os.getenv('DEEPSEEK_API_KEY'),
-    base_url="https://api.deepseek.com"
-)
+# 向量库 (作为写入目标) 通过 get_memory_core() 获取，与 services 共用同一个实例
 
-# 初始化向量库 (作为写入目标)
-memory_core = VectorMemory()
+def iter_messages_since_last_sleep(db: Session, user: models.User, batch_size: int = SLEEP_FETCH_SIZE):
+    """
+    按时间顺序逐条产出自上次睡眠以来的对话
+    按 (created_at, id) 游标分批查询，每批都走 (user_id, created_at) 索引；
+    只取整理需要的几列（轻量的行，不是 ORM 对象），积压很多消息时也不会把整张表的对象堆进会话
+    """
+    cursor = None
+    while True:
+        query = db.query(
+            models.Message.id,
+            models.Message.idea_id,
+            models.Message.role,
+            models.Message.content,
+            models.Message.created_at
+        ).filter(
+            models.Message.user_id == user.id,
+            models.Message.created_at > user.last_sleep_time
+        )
+        if cursor:
+            query = query.filter(crud.after_cursor(cursor))
+        rows = query.order_by(models.Message.created_at.asc(), models.Message.id.asc()).limit(batch_size).all()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        cursor = (rows[-1].created_at, rows[-1].id)
 
 def get_messages_since_last_sleep(db: Session, user: models.User):
     """
     从 SQL 中提取自上次睡眠以来的所有对话
     """
-    # 查找所有 created_at > last_sleep_time 的消息
-    new_msgs = db.query(models.Message).filter(
-        models.Message.user_id == user.id,
-        models.Message.created_at > user.last_sleep_time
-    ).order_by(models.Message.created_at.asc()).all()
-    
-    return new_msgs
+    return list(iter_messages_since_last_sleep(db, user))
+
+def get_retry_messages(db: Session, user: models.User, task: str):
+    """
+    上次睡眠里 task（knowledge / persona）这一步整理失败、要重做的消息，按时间顺序
+    """
+    return db.query(
+        models.Message.id,
+        models.Message.idea_id,
+        models.Message.role,
+        models.Message.content,
+        models.Message.created_at
+    ).join(models.SleepRetry, and_(
+        models.SleepRetry.message_id == models.Message.id,
+        models.SleepRetry.user_id == user.id,
+        models.SleepRetry.task == task
+    )).order_by(models.Message.created_at.asc(), models.Message.id.asc()).all()
+
+def load_sleep_windows(db: Session, user: models.User):
+    """
+    读出这次要整理的对话并切好窗口，每个窗口带上要做的步骤 tasks 和是否是重试 retry
+    - 上次失败的消息只重做失败的那一步（知识提取 / 画像更新），排在前面（它们更早）
+    - 水位线之后的新消息两步都做
+    """
+    windows = []
+    for task in ("persona", "knowledge"):
+        for window in segment_messages(get_retry_messages(db, user, task)):
+            window.update(tasks={task}, retry=True)
+            windows.append(window)
+    for window in segment_messages(iter_messages_since_last_sleep(db, user)):
+        window.update(tasks={"persona", "knowledge"}, retry=False)
+        windows.append(window)
+    return windows
+
+def save_sleep_result(db: Session, user: models.User, persona: str, knowledge_items, windows, failed, memory_seq=None):
+    """
+    一个事务写入睡眠结果：知识、画像、水位线、重试记录
+    knowledge_items:[(向量库 id, 原文, 标签列表)]
+    failed:[(窗口, 失败的步骤)]，这些窗口的消息记进 sleep_retries，下次只重做这一步
+    水位线总是前进到本次读到的最后一条新消息：失败的部分靠重试记录补，成功的窗口不会被再整理一遍
+    """
+    if knowledge_items:
+        crud.save_knowledge(db, user.id, knowledge_items)
+    user.persona = persona
+
+    loaded = {(m.id, task) for w in windows if w["retry"] for task in w["tasks"] for m in w["messages"]}
+    still_failed = {(m.id, task) for w, task in failed for m in w["messages"]}
+    for message_id, task in loaded - still_failed:
+        db.query(models.SleepRetry).filter(
+            models.SleepRetry.user_id == user.id,
+            models.SleepRetry.message_id == message_id,
+            models.SleepRetry.task == task
+        ).delete()
+    for message_id, task in still_failed - loaded:
+        db.add(models.SleepRetry(user_id=user.id, message_id=message_id, task=task))
+
+    new_messages = [m for w in windows if not w["retry"] for m in w["messages"]]
+    if new_messages:
+        user.last_sleep_time = max(m.created_at for m in new_messages)
+    if memory_seq is not None:
+        user.memory_seq = memory_seq
+    db.commit()
+    # 提交后属性过期了，在这里（线程里）重新读好，回到事件循环上再读 user 不会查库
+    db.refresh(user)
+
+def get_new_memories(user: models.User):
+    """
+    从向量库读出这个用户上次睡眠之后新写入的记忆（论文摘要、批驳等，不含睡眠自己写的知识）
+    按写入序号增量读，检查点是 user.memory_seq
+    """
+    filter_metadata = {"$and": [{"user_id": user.id}, {"role": {"$ne": "implicit_knowledge"}}]}
+    return list(get_memory_core().get_new_memory_for_sleep(user.memory_seq or 0, filter_metadata=filter_metadata))
+
+def build_reference_text(memories, max_tokens: int = SLEEP_REFERENCE_TOKENS):
+    """
+    新记忆拼成参考资料，按写入顺序放进 token 预算，超出的部分截掉
+    """
+    text = "\n".join(m["content"] for m in sorted(memories, key=lambda m: m["seq"]))
+    return token_budget.truncate_to_tokens(text, max_tokens)
 
-def generate_implicit_knowledge(user_id: int, chat_history_text: str):
+async def generate_implicit_knowledge(user_id: int, chat_history_text: str, strict: bool = False, reference_text: str = ""):
     """
     【任务 B】: 隐式知识固化
     让 AI 像看课堂笔记一样，从对话中总结出知识点
+    strict:失败时抛异常而不是返回空列表（分窗口整理时要知道哪个窗口失败了）
+    reference_text:上次睡眠之后新读的论文摘要，帮助判断对话里提到的结论出自哪里
     """
     system_prompt = """
     你是一个科研知识整理员。你的任务是阅读用户的聊天记录，提取出**长期有价值的科研知识**。
@@ -60,27 +165,29 @@ def generate_implicit_knowledge(user_id: int, chat_history_text: str):
     如果没有提取到任何有价值的知识，请直接输出空列表 []。
     """
     
+    user_prompt = f"【今日对话记录】:\n{chat_history_text}"
+    if reference_text:
+        user_prompt += f"\n【近期新读的论文】（仅作参考，只提取对话中涉及的内容）:\n{reference_text}"
+
     try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"【今日对话记录】:\n{chat_history_text}"}
-            ],
-            stream=False
-        )
-        content = response.choices[0].message.content
+        content = await llm_gateway.chat_completion([
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ])
         # 清洗一下 markdown
         content = content.replace("```json", "").replace("```", "").strip()
         knowledge_list = json.loads(content)
         return knowledge_list
     except Exception as e:
         print(f"  [知识提取失败] {e}")
+        if strict:
+            raise
         return []
 
-def update_user_persona(current_persona: str, chat_history_text: str):
+async def update_user_persona(current_persona: str, chat_history_text: str, strict: bool = False):
     """
     【任务 A】: 更新用户画像
+    strict:失败时抛异常而不是返回旧画像
     """
     system_prompt = """
     你是一个用户画像侧写师。请根据今日的对话更新用户的【科研画像】。
@@ -99,85 +206,393 @@ def update_user_persona(current_persona: str, chat_history_text: str):
     """
     
     try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            stream=False
-        )
-        content = response.choices[0].message.content.replace("```json", "").replace("```", "").strip()
+        content = await llm_gateway.chat_completion([
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ])
+        content = content.replace("```json", "").replace("```", "").strip()
         # 简单验证一下是不是 JSON
         json.loads(content) 
         return content
     except Exception as e:
         print(f"  [画像更新失败] {e}")
+        if strict:
+            raise
         return current_persona # 失败了就返回旧的，别改坏了
 
-def process_one_user(db: Session, user: models.User):
+def segment_messages(msgs, max_tokens: int = SLEEP_WINDOW_TOKENS):
+    """
+    把新对话切成若干窗口：先按 Idea 分组（同一个话题放在一起），组内按时间顺序装满 max_tokens 为止
+    单条超长的消息会被拆成几段，保证不丢内容
+    msgs 可以是按时间排序的迭代器（iter_messages_since_last_sleep），边读边切，只过一遍
+    返回 [{"idea_id", "text", "messages": [Message...]}]
+    """
+    windows = []
+    current_by_idea = {} # idea_id -> 这个 Idea 正在装的窗口
+    for msg in msgs:
+        current = current_by_idea.setdefault(msg.idea_id, {"idea_id": msg.idea_id, "lines": [], "messages": [], "tokens": 0})
+        for piece in token_budget.split_by_tokens(f"[{msg.role}]: {msg.content}", max_tokens):
+            piece_tokens = token_budget.estimate_tokens(piece)
+            if current["lines"] and current["tokens"] + piece_tokens > max_tokens:
+                windows.append(current)
+                current = {"idea_id": msg.idea_id, "lines": [], "messages": [], "tokens": 0}
+                current_by_idea[msg.idea_id] = current
+            current["lines"].append(piece)
+            current["tokens"] += piece_tokens
+            if not current["messages"] or current["messages"][-1] is not msg:
+                current["messages"].append(msg)
+    windows.extend(w for w in current_by_idea.values() if w["lines"])
+    # 同一个 Idea 的窗口排在一起，和按 Idea 分组时的顺序一致（画像按这个顺序折叠）
+    order = {idea_id: i for i, idea_id in enumerate(current_by_idea)}
+    windows.sort(key=lambda w: order[w["idea_id"]])
+
+    return [
+        {"idea_id": w["idea_id"], "text": "\n".join(w["lines"]) + "\n", "messages": w["messages"]}
+        for w in windows
+    ]
+
+def dedupe_knowledge(knowledge_list, threshold: float = SLEEP_DEDUP_THRESHOLD):
+    """
+    Reduce 阶段：不同窗口经常提炼出几乎一样的知识点，按向量相似度去重（保留先出现的，合并标签）
+    """
+    items = [k for k in knowledge_list if isinstance(k, dict) and k.get('content')]
+    if len(items) < 2:
+        return items
+    vectors = np.asarray(get_memory_core().embedding_func([k['content'] for k in items]), dtype=np.float32)
+    # 模型自带 Normalize，保险起见再归一化一次，点积就是余弦相似度
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+
+    kept = []
+    for i, item in enumerate(items):
+        duplicate_of = None
+        for j in kept:
+            if float(vectors[i] @ vectors[j]) >= threshold:
+                duplicate_of = j
+                break
+        if duplicate_of is None:
+            kept.append(i)
+        else:
+            tags = items[duplicate_of].setdefault('tags', [])
+            for tag in item.get('tags', []):
+                if tag not in tags:
+                    tags.append(tag)
+    return [items[i] for i in kept]
+
+async def process_one_user(db: Session, user: models.User, progress: dict = None):
+    """
+    progress:可选的进度字典，整理过程中会实时更新（给 /system/sleep/ 的状态查询用）
+    返回整理失败的窗口数（0 = 全部整理完）
+    """
+    if progress is None:
+        progress = {}
     print(f"\n💤 用户 [{user.username}] 进入睡眠处理...")
 
-    # 1. 获取新记忆 (从 SQL 读取)
-    new_msgs = get_messages_since_last_sleep(db, user)
-    
-    if not new_msgs:
+    # 1. 获取新记忆 (从 SQL 分批读取，边读边按 Idea 和 token 预算切窗口)，加上上次失败要重做的
+    # 对话不多时就是一个窗口，和以前一样两次调用
+    # SQL 分批读取和分词切窗口都放到线程里：手动睡眠跑在 API 的事件循环上，不能卡住其他请求
+    windows = await asyncio.to_thread(load_sleep_windows, db, user)
+    # 超长消息拆开后可能跨两个窗口，按 id 去重计数
+    msg_count = len({m.id for w in windows for m in w["messages"]})
+    progress["messages_read"] = msg_count
+
+    if not windows:
         print("  -> 无新对话，跳过。")
         # 即使没有新对话，也可以选择更新一下时间，或者不做操作
-        return
+        return 0
 
-    print(f"  -> 发现 {len(new_msgs)} 条新对话，开始大脑整理...")
-    
-    # 拼装对话文本
-    chat_text = ""
-    for msg in new_msgs:
-        chat_text += f"[{msg.role}]: {msg.content}\n"
+    progress["windows_total"] = len(windows)
+    progress["windows_processed"] = 0
+    retry_count = sum(1 for w in windows if w["retry"])
+    print(f"  -> 发现 {msg_count} 条对话，分成 {len(windows)} 个窗口（其中 {retry_count} 个是上次失败的重试），开始大脑整理...")
+
+    # 上次睡眠之后新写入的论文摘要等记忆，作为提取知识时的参考
+    new_memories = await asyncio.to_thread(get_new_memories, user)
+    reference_text = build_reference_text(new_memories)
+    if new_memories:
+        print(f"  -> 附带 {len(new_memories)} 条新记忆作为参考")
+
+    knowledge_windows = [w for w in windows if "knowledge" in w["tasks"]]
+    persona_windows = [w for w in windows if "persona" in w["tasks"]]
+
+    # 2. Map：每个窗口并发提取知识
+    async def extract(window):
+        try:
+            return await generate_implicit_knowledge(user.id, window["text"], strict=True, reference_text=reference_text)
+        finally:
+            progress["windows_processed"] += 1
+
+    # 画像需要在上一个窗口的基础上继续更新，所以按顺序折叠（和知识提取同时进行）
+    async def fold_persona():
+        persona = user.persona
+        failed = []
+        for window in persona_windows:
+            try:
+                persona = await update_user_persona(persona, window["text"], strict=True)
+            except Exception:
+                failed.append(window)
+        return persona, failed
+
+    results = await asyncio.gather(
+        fold_persona(),
+        *[extract(w) for w in knowledge_windows],
+        return_exceptions=True
+    )
+    if isinstance(results[0], BaseException):
+        raise results[0]
+    new_persona, persona_failed = results[0]
+    knowledge_results = results[1:]
+
+    failed = [(w, "persona") for w in persona_failed]
+    knowledge_list = []
+    for window, result in zip(knowledge_windows, knowledge_results):
+        if isinstance(result, BaseException) or not isinstance(result, list):
+            failed.append((window, "knowledge"))
+        else:
+            knowledge_list.extend(result)
 
-    # 2. 执行任务 A: 更新画像
-    new_persona = update_user_persona(user.persona, chat_text)
     if new_persona != user.persona:
         print(f"  -> 画像已更新")
-        user.persona = new_persona
-    
-    # 3. 执行任务 B: 隐式知识提取 (The Magic)
-    knowledge_list = generate_implicit_knowledge(user.id, chat_text)
+        progress["persona_updated"] = True
     
+    # 3. Reduce：去重后固化隐式知识
+    knowledge_list = await asyncio.to_thread(dedupe_knowledge, knowledge_list)
+
+    knowledge_items = []
     if knowledge_list:
         print(f"  -> 提炼出 {len(knowledge_list)} 条隐式知识，正在固化...")
+        now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        texts = []
+        metadatas = []
+        tags = []
         for k in knowledge_list:
-            text = k.get('content', '')
+            text = k.get('content', '') if isinstance(k, dict) else ''
             if text:
-                # 存入向量库
-                memory_core.add_memory(
-                    text=f"【睡眠整理知识】{text}",
-                    metadata={
-                        "user_id": user.id,
-                        "role": "implicit_knowledge", # 关键标记：这是睡觉得来的
-                        "source": "sleep_consolidation",
-                        "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                )
+                texts.append(f"【睡眠整理知识】{text}")
+                metadatas.append({
+                    "user_id": user.id,
+                    "role": "implicit_knowledge", # 关键标记：这是睡觉得来的
+                    "source": "sleep_consolidation",
+                    "timestamp": now_str
+                })
+                tags.append(k.get('tags') or [])
+        # 一次批量存入向量库（id 按内容哈希生成，重跑不会重复）
+        mem_ids = await asyncio.to_thread(get_memory_core().add_memories, texts, metadatas=metadatas)
+        # SQL 里也留一份，重建向量库（reindex.py）时从这里读
+        knowledge_items = list(zip(mem_ids, texts, tags))
+        progress["knowledge_written"] = len(texts)
     else:
         print("  -> 今日对话主要是闲聊，未提取到深度知识。")
 
     # 4. 标记睡眠完成
-    user.last_sleep_time = datetime.datetime.utcnow()
-    db.commit()
+    # 用本次读到的最后一条新消息的时间做水位线，处理期间新来的消息留给下一次
+    # 失败的窗口只把消息和失败的步骤记下来，下次只重做那一步，成功的部分不会重复整理
+    if failed:
+        print(f"  -> {len(failed)} 个窗口整理失败，下次睡眠只重做失败的部分")
+    # 记忆检查点只在全部窗口成功时前进，失败窗口重新整理时还能带上同一批参考
+    memory_seq = max(m["seq"] for m in new_memories) if new_memories and not failed else None
+    # 提交可能要等 SQLite 写锁，同样放到线程里
+    await asyncio.to_thread(save_sleep_result, db, user, new_persona, knowledge_items, windows, failed, memory_seq=memory_seq)
+    # 画像和知识变了，这个用户之前缓存的回答作废（睡眠在另一个进程里跑时，靠水位线变化让缓存对不上）
+    response_cache.invalidate(user_id=user.id)
     print(f"  -> [{user.username}] 睡眠结束，精力已恢复。")
+    return len(failed)
 
-def run_sleep_cycle():
+class SleepTaskManager:
     """
-    主程序
+    手动触发的睡眠任务：在后台跑，立刻返回 task_id，进度保存在内存里供轮询
+    同一个用户已经有任务在跑时，重复触发直接返回那个任务，不会并行整理同一个人
+    """
+    def __init__(self, max_finished: int = 1000):
+        self.tasks = {} # task_id -> 进度字典
+        self._active = {} # user_id -> 正在跑的 task_id
+        self._running = set() # asyncio.Task 引用，防止被回收
+        self.max_finished = max_finished
+
+    def submit(self, user_id: int):
+        """
+        提交一个用户的睡眠任务，返回 (进度字典, 是否复用了已有任务)
+        """
+        task_id = self._active.get(user_id)
+        if task_id:
+            return self.tasks[task_id], True
+
+        task_id = uuid.uuid4().hex
+        progress = {
+            "task_id": task_id,
+            "user_id": user_id,
+            "status": "queued", # queued / running / done / failed
+            "messages_read": 0,
+            "windows_total": 0,
+            "windows_processed": 0,
+            "knowledge_written": 0,
+            "persona_updated": False,
+            "new_persona": None,
+            "error": None,
+            "created_at": datetime.datetime.utcnow(),
+            "finished_at": None
+        }
+        self.tasks[task_id] = progress
+        self._active[user_id] = task_id
+        task = asyncio.create_task(self._run(progress))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+        self._prune()
+        return progress, False
+
+    def get(self, task_id: str):
+        return self.tasks.get(task_id)
+
+    async def _run(self, progress: dict):
+        progress["status"] = "running"
+        # 这个任务跑在 API 的事件循环上：查库、回滚、关连接都放到线程里，只有调 LLM 留在循环上
+        session = SessionLocal()
+        try:
+            user = await asyncio.to_thread(session.get, models.User, progress["user_id"])
+            await process_one_user(session, user, progress=progress)
+            progress["new_persona"] = user.persona
+            progress["status"] = "done"
+        except Exception as e:
+            await asyncio.to_thread(session.rollback)
+            progress["status"] = "failed"
+            progress["error"] = str(e)
+            print(f"  [用户 {progress['user_id']} 睡眠失败] {e}")
+        finally:
+            await asyncio.to_thread(session.close)
+            progress["finished_at"] = datetime.datetime.utcnow()
+            self._active.pop(progress["user_id"], None)
+
+    def _prune(self):
+        # 只保留最近的一批已结束任务
+        finished = [t for t in self.tasks.values() if t["finished_at"] is not None]
+        if len(finished) <= self.max_finished:
+            return
+        finished.sort(key=lambda t: t["finished_at"])
+        for t in finished[:len(finished) - self.max_finished]:
+            self.tasks.pop(t["task_id"], None)
+
+    async def stop(self):
+        for task in list(self._running):
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+# 全局唯一的手动睡眠任务管理器
+sleep_tasks = SleepTaskManager()
+
+def get_users_with_new_messages(db: Session):
+    """
+    聚合查询找出所有有新对话或者有待重试消息的用户，返回 {user_id: 要整理的消息条数}
+    """
+    rows = db.query(models.Message.user_id, func.count(models.Message.id)).join(
+        models.User, models.User.id == models.Message.user_id
+    ).filter(
+        models.Message.created_at > models.User.last_sleep_time
+    ).group_by(models.Message.user_id).all()
+    pending = {user_id: count for user_id, count in rows}
+    # 上次有窗口整理失败的用户，没有新对话也要把失败的部分重做
+    retries = db.query(models.SleepRetry.user_id, func.count(func.distinct(models.SleepRetry.message_id))).group_by(
+        models.SleepRetry.user_id
+    ).all()
+    for user_id, count in retries:
+        pending[user_id] = pending.get(user_id, 0) + count
+    return pending
+
+def start_cycle(db: Session):
+    """
+    开一个新周期；上次被打断、没收尾的周期直接关掉
+    不用续跑旧周期：每个用户的 last_sleep_time 水位线和重试记录已经保证重跑不会重复整理、也不会漏掉
+    """
+    stale = db.query(models.SleepCycle).filter(models.SleepCycle.finished_at.is_(None)).all()
+    for old_cycle in stale:
+        print(f"  -> 关闭上次未完成的睡眠周期 #{old_cycle.id}")
+        old_cycle.finished_at = datetime.datetime.utcnow()
+    cycle = models.SleepCycle()
+    db.add(cycle)
+    db.commit()
+    db.refresh(cycle)
+    return cycle
+
+def save_checkpoint(db: Session, cycle_id: int, user_id: int, status: str, messages: int = 0, error: str = None):
+    checkpoint = db.get(models.SleepCheckpoint, (cycle_id, user_id))
+    if checkpoint is None:
+        checkpoint = models.SleepCheckpoint(cycle_id=cycle_id, user_id=user_id)
+        db.add(checkpoint)
+    checkpoint.status = status
+    checkpoint.messages = messages
+    checkpoint.error = error
+    db.commit()
+
+def open_cycle():
+    """
+    开新周期并找出要整理的用户，返回 (cycle_id, {user_id: 消息条数})
     """
-    print("=== 研究助手后台睡眠系统启动 ===")
     db = SessionLocal()
     try:
-        users = db.query(models.User).all()
-        for user in users:
-            process_one_user(db, user)
+        cycle_id = start_cycle(db).id
+        return cycle_id, get_users_with_new_messages(db)
     finally:
         db.close()
+
+def close_cycle(cycle_id: int):
+    """
+    给周期收尾，返回没整理完（failed / partial）的用户数
+    """
+    db = SessionLocal()
+    try:
+        failed = db.query(models.SleepCheckpoint).filter(
+            models.SleepCheckpoint.cycle_id == cycle_id,
+            models.SleepCheckpoint.status.in_(["failed", "partial"])
+        ).count()
+        cycle = db.get(models.SleepCycle, cycle_id)
+        cycle.finished_at = datetime.datetime.utcnow()
+        db.commit()
+        return failed
+    finally:
+        db.close()
+
+async def run_sleep_cycle(max_workers: int = SLEEP_WORKERS):
+    """
+    主程序：多个用户并发整理（最多 max_workers 个同时跑，每个用户单独一个数据库会话）
+    每处理完一个用户就写检查点（记录用）；谁要整理只看水位线之后有没有新消息、有没有待重试的消息，
+    上次失败或被打断的用户这次会自然重新整理，部分窗口失败的用户只重做失败的部分
+    """
+    print("=== 研究助手后台睡眠系统启动 ===")
+    # 老记忆没有写入序号时先补上（只在第一次跑）
+    await asyncio.to_thread(get_memory_core().backfill_sequence)
+    cycle_id, pending = await asyncio.to_thread(open_cycle)
+    print(f"  -> 本次需要整理 {len(pending)} 个用户")
+
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def sleep_one(user_id: int, msg_count: int):
+        async with semaphore:
+            session = SessionLocal()
+            try:
+                user = await asyncio.to_thread(session.get, models.User, user_id)
+                failed_windows = await process_one_user(session, user)
+                # partial：有窗口失败，失败的部分记在 sleep_retries，下次睡眠重做
+                await asyncio.to_thread(
+                    save_checkpoint, session, cycle_id, user_id, "partial" if failed_windows else "done", messages=msg_count
+                )
+            except Exception as e:
+                await asyncio.to_thread(session.rollback)
+                print(f"  [用户 {user_id} 睡眠失败] {e}")
+                await asyncio.to_thread(save_checkpoint, session, cycle_id, user_id, "failed", messages=msg_count, error=str(e))
+            finally:
+                await asyncio.to_thread(session.close)
+
+    try:
+        await asyncio.gather(*[sleep_one(uid, n) for uid, n in pending.items()])
+
+        # 周期总是收尾；失败的用户下次睡眠会重新整理
+        failed = await asyncio.to_thread(close_cycle, cycle_id)
+        if failed:
+            print(f"  -> 有 {failed} 个用户没整理完，下次睡眠会重试")
+    finally:
+        await llm_gateway.aclose()
         print("=== 睡眠周期结束 ===")
 
 if __name__ == "__main__":
-    run_sleep_cycle()
\ No newline at end of file
+    # 单独运行时也确保表结构是最新的（睡眠周期和检查点表）
+    models.Base.metadata.create_all(bind=engine)
+    migrate()
+    asyncio.run(run_sleep_cycle())
\ No newline at end of file
@@ -0,0 +1,102 @@
+'''
+此代码是一个本地的假 DeepSeek 服务器，用于离线测试和并发压测
+启动：uvicorn stub_llm_server:app --port 9000
+然后设置环境变量 DEEPSEEK_BASE_URL=http://127.0.0.1:9000 再启动 main.py
+GET /stats 可以看到收到的请求总数和最大同时在飞请求数
+支持 stream=true（按 OpenAI 的 SSE 格式分段返回），用来测首 token 延迟
+'''
+import asyncio
+import os
+import time
+import json
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+# 模拟 LLM 的响应延迟（秒）
+STUB_DELAY = float(os.getenv("STUB_LLM_DELAY", "0.5"))
+# 流式时每个分片之间的间隔（秒）和分片大小（字符）
+STUB_TOKEN_DELAY = float(os.getenv("STUB_LLM_TOKEN_DELAY", "0.02"))
+STUB_CHUNK_CHARS = 4
+
+app = FastAPI(title="DeepSeek Stub")
+
+stats = {"total": 0, "in_flight": 0, "max_in_flight": 0}
+
+def fake_reply(messages):
+    '''
+    根据 prompt 里的关键字，返回各个调用方能解析的内容
+    '''
+    prompt = "\n".join([str(m.get("content", "")) for m in messages])
+    if "请打分" in prompt:
+        return json.dumps({"score": 7, "reason": "stub: 存在冲突"}, ensure_ascii=False)
+    if "反对意见" in prompt:
+        return json.dumps(["stub 局限性", "stub 替代方案", "stub 缺点"], ensure_ascii=False)
+    if '"summary"' in prompt:
+        return json.dumps({"summary": "stub 摘要", "claims": ["stub 贡献"], "critiques": ["stub 局限"]}, ensure_ascii=False)
+    if "知识整理员" in prompt:
+        return json.dumps([{"content": "stub 知识点", "tags": ["stub"]}], ensure_ascii=False)
+    if "画像侧写师" in prompt:
+        return json.dumps(["研究方向: stub"], ensure_ascii=False)
+    return f"stub 回复（共 {len(prompt)} 字符的 prompt）"
+
+async def stream_reply(body):
+    '''
+    按 OpenAI 的 SSE 格式一小段一小段地吐：先等 STUB_DELAY（模拟首 token 延迟），之后每段间隔 STUB_TOKEN_DELAY
+    '''
+    try:
+        await asyncio.sleep(STUB_DELAY)
+        content = fake_reply(body.get("messages", []))
+        for i in range(0, len(content), STUB_CHUNK_CHARS):
+            chunk = {
+                "id": f"stub-{stats['total']}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "deepseek-chat"),
+                "choices": [{"index": 0, "delta": {"content": content[i:i + STUB_CHUNK_CHARS]}, "finish_reason": None}]
+            }
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(STUB_TOKEN_DELAY)
+        yield "data: [DONE]\n\n"
+    finally:
+        stats["in_flight"] -= 1
+
+@app.post("/chat/completions")
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["total"] += 1
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    if body.get("stream"):
+        return StreamingResponse(stream_reply(body), media_type="text/event-stream")
+    try:
+        await asyncio.sleep(STUB_DELAY)
+        content = fake_reply(body.get("messages", []))
+    finally:
+        stats["in_flight"] -= 1
+
+    return {
+        "id": f"stub-{stats['total']}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "deepseek-chat"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    }
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+@app.post("/stats/reset")
+def reset_stats():
+    stats.update({"total": 0, "in_flight": 0, "max_in_flight": 0})
+    return stats
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("STUB_LLM_PORT", "9000")))
@@ -0,0 +1,130 @@
+'''
+此代码用于计算文本的 token 数，控制每次发给 LLM 的内容不超预算
+- 默认用仓库自带的 all-MiniLM-L6-v2 的 tokenizer.json 计数；PROMPT_TOKENIZER 可以换成别的（比如 DeepSeek 的）
+- 找不到分词器文件、没装 tokenizers 或者 PROMPT_TOKENIZER=heuristic 时粗略估算：
+  中日韩文字一个字约一个 token，其余字符约 4 个一个 token
+'''
+import os
+import re
+import threading
+
+# 本地分词器文件（tokenizers 格式的 tokenizer.json），留空用自带模型的分词器，heuristic 表示只用估算
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "")
+
+_current_dir = os.path.dirname(os.path.abspath(__file__))
+# 自带模型的分词器（和 vector_memory 用同一个模型目录，也兼容放在仓库根目录的 models/）
+BUNDLED_TOKENIZERS = [
+    os.path.join(_current_dir, 'models', 'all-MiniLM-L6-v2', 'tokenizer.json'),
+    os.path.join(os.path.dirname(_current_dir), 'models', 'all-MiniLM-L6-v2', 'tokenizer.json'),
+]
+
+_CJK_RE = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+# 句子边界：中英文句末标点、换行之后
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？；.!?;\n])")
+
+_tokenizer = None # None = 还没加载，False = 加载不了，退回估算
+_tokenizer_lock = threading.Lock()
+
+def _tokenizer_path():
+    if PROMPT_TOKENIZER == "heuristic":
+        return None
+    if PROMPT_TOKENIZER:
+        return PROMPT_TOKENIZER
+    return next((path for path in BUNDLED_TOKENIZERS if os.path.exists(path)), None)
+
+def get_tokenizer():
+    '''
+    懒加载本地分词器，加载不了返回 None（只在第一次打印原因）
+    '''
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                _tokenizer = _load_tokenizer()
+    return _tokenizer or None
+
+def _load_tokenizer():
+    path = _tokenizer_path()
+    if path is None:
+        return False
+    try:
+        from tokenizers import Tokenizer
+        tokenizer = Tokenizer.from_file(path)
+    except Exception as e:
+        print(f"[Token] 分词器加载失败，改用估算: {e}")
+        return False
+    # tokenizer.json 里可能带着模型的截断 / 补齐设置，计数时要关掉，否则长文本会被截成 max_length
+    tokenizer.no_truncation()
+    tokenizer.no_padding()
+    return tokenizer
+
+def estimate_tokens(text):
+    '''
+    计算一段文本的 token 数（有分词器时精确，否则宁多勿少地估算）
+    '''
+    if not text:
+        return 0
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def split_by_tokens(text,max_tokens):
+    '''
+    把超长文本按 token 预算切成几段，各段首尾相接，不丢内容
+    有分词器时整段只编码一次，按每个 token 在原文里的位置（offsets）每 max_tokens 个切一刀；
+    没有分词器时逐字累加估算值，也只扫一遍
+    '''
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+    max_tokens = max(1, max_tokens)
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        offsets = tokenizer.encode(text, add_special_tokens=False).offsets
+        cuts = [offsets[i][0] for i in range(max_tokens, len(offsets), max_tokens)]
+    else:
+        cuts = []
+        start, cjk, other = 0, 0, 0
+        for i, ch in enumerate(text):
+            is_cjk = _CJK_RE.match(ch) is not None
+            if i > start and (cjk + is_cjk) + (other + (not is_cjk) + 3) // 4 > max_tokens:
+                cuts.append(i)
+                start, cjk, other = i, 0, 0
+            cjk += is_cjk
+            other += not is_cjk
+    pieces = []
+    start = 0
+    for cut in cuts:
+        if cut > start:
+            pieces.append(text[start:cut])
+            start = cut
+    pieces.append(text[start:])
+    return pieces
+
+def truncate_to_tokens(text,max_tokens,suffix="……"):
+    '''
+    把文本截到 max_tokens 以内，尽量在句子边界处截断（保留开头）
+    截断了会在末尾加上 suffix
+    '''
+    if not text or max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - estimate_tokens(suffix)
+    if budget <= 0:
+        return ""
+    # 二分找出预算内最长的前缀
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    prefix = text[:lo]
+    # 回退到最后一个句子边界；边界太靠前（丢掉一半以上）就直接硬截
+    boundaries = [m.start() for m in _SENTENCE_END_RE.finditer(prefix)]
+    if boundaries and boundaries[-1] >= len(prefix) // 2:
+        prefix = prefix[:boundaries[-1]]
+    return prefix.rstrip() + suffix
@@ -1,18 +1,11 @@
 '''
 此代码为llm可调用的工具（计划更新agent function calling，目前都是代码写死的调用）
 '''
+import asyncio
 import json
-import os
-import openai
-from dotenv import load_dotenv
+import llm_gateway
 
-load_dotenv()
-client = openai.OpenAI(
-    api_key=os.getenv('DEEPSEEK_API_KEY'),
-    base_url="https://api.deepseek.com"
-)
-
-def generate_adversarial_keywords(user_idea: str):
+async def generate_adversarial_keywords(user_idea: str):
     """
     【找茬器】: 根据用户的 Idea，生成专门用来搜索反驳证据的关键词。
     """
@@ -23,16 +16,12 @@ def generate_adversarial_keywords(user_idea: str):
     只输出 JSON 列表。
     """
     try:
-        res = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[{"role": "user", "content": prompt}],
-            stream=False
-        )
-        return json.loads(res.choices[0].message.content.replace("```json", "").replace("```", "").strip())
-    except:
+        content = await llm_gateway.chat_completion([{"role": "user", "content": prompt}])
+        return json.loads(content.replace("```json", "").replace("```", "").strip())
+    except Exception:
         return [f"{user_idea} 局限性", f"反驳 {user_idea}"]
 
-def calculate_conflict_score(user_idea: str, evidence: str):
+async def calculate_conflict_score(user_idea: str, evidence: str):
     """
     【逻辑量化器】: 计算 Evidence 对 Idea 的逻辑冲击力 (0-10分)。
     """
@@ -49,11 +38,49 @@ def calculate_conflict_score(user_idea: str, evidence: str):
     输出 JSON: {{"score": int, "reason": "简短理由"}}
     """
     try:
-        res = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[{"role": "user", "content": prompt}],
-            stream=False
-        )
-        return json.loads(res.choices[0].message.content.replace("```json", "").replace("```", "").strip())
-    except:
-        return {"score": 0, "reason": "无法评估"}
\ No newline at end of file
+        content = await llm_gateway.chat_completion([{"role": "user", "content": prompt}])
+        return json.loads(content.replace("```json", "").replace("```", "").strip())
+    except Exception:
+        return {"score": 0, "reason": "无法评估"}
+
+async def calculate_conflict_scores(user_idea: str, evidences: list, min_score=6, enough=3, max_concurrency=4):
+    """
+    【并发量化器】: 对一批 Evidence 并发打分（最多 max_concurrency 个同时在飞）。
+    一旦已经拿到 enough 条高分冲突 (score >= min_score)，就取消剩下的打分，提前返回。
+    返回高分冲突列表: [{"content", "score", "reason"}]
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def score_one(evi):
+        async with semaphore:
+            assessment = await calculate_conflict_score(user_idea, evi)
+        return evi, assessment
+
+    tasks = [asyncio.create_task(score_one(evi)) for evi in evidences]
+    high_conflict_points = []
+    try:
+        for fut in asyncio.as_completed(tasks):
+            evi, assessment = await fut
+            if not isinstance(assessment, dict):
+                continue
+            try:
+                score = int(assessment.get('score', 0))
+            except (TypeError, ValueError):
+                score = 0
+            if score >= min_score:
+                high_conflict_points.append({
+                    "content": evi,
+                    "score": score,
+                    "reason": assessment.get('reason', '')
+                })
+                if len(high_conflict_points) >= enough:
+                    break
+    finally:
+        # 提前结束（或出错）时，把还没跑完的打分全部取消
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # 分数高的排前面
+    high_conflict_points.sort(key=lambda x: x['score'], reverse=True)
+    return high_conflict_points
\ No newline at end of file
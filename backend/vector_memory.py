@@ -3,10 +3,248 @@
 '''
 import chromadb
 from chromadb.utils import embedding_functions
+from collections import OrderedDict
+import numpy as np
+import threading
+import unicodedata
+import hashlib
+import datetime
+import time
+import re
 import os
+from embedding_store import EmbeddingStore
+from lexical_index import LexicalIndex
+from write_sequence import WriteSequence
+import rerank
+
+class EmbeddingCache:
+    '''
+    查询向量的 LRU 缓存：同一个问题不再重复跑模型
+    key = (模型路径, 归一化后的文本)，value = float32 向量
+    同时受条目数和总字节数限制，超了就淘汰最久没用的
+    '''
+    def __init__(self,max_entries=4096,max_bytes=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock() # 检索会被丢到线程池里跑，要加锁
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text):
+        '''
+        全半角统一 + 合并空白，"X  局限性 " 和 "X 局限性" 算同一个问题
+        '''
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+    def get(self,key):
+        with self._lock:
+            vec = self._data.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self,key,vec):
+        vec = np.asarray(vec, dtype=np.float32)
+        if vec.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._data[key] = vec
+            self._bytes += vec.nbytes
+            # 淘汰最久没用的
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+# 检索模式：hybrid = 向量 + 关键词(BM25) 按 RRF 融合，dense = 只用向量
+SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid")
+# 融合时每一路各取多少条候选
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", "20"))
+# RRF 的平滑常数：score = sum(1 / (k + 名次))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# 嵌入后端：torch = sentence-transformers（PyTorch fp32），onnx = ONNX Runtime（CPU 上更快）
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+# onnx 后端是否用 int8 动态量化的模型（更快更省内存，精度略降）
+EMBED_QUANTIZE = os.getenv("EMBED_QUANTIZE", "0") == "1"
+# onnx 后端每批最多编码几条
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+# 句子最多取多少个 token（和 all-MiniLM-L6-v2 的 max_seq_length 一致）
+EMBED_MAX_LENGTH = 256
+
+def export_onnx(model_path):
+    '''
+    模型目录下没有 model.onnx 时，用 transformers 把模型导出一份（只需要做一次），返回 onnx 文件路径
+    '''
+    onnx_path = os.path.join(model_path, "model.onnx")
+    if os.path.exists(onnx_path):
+        return onnx_path
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    print(f"[Embedding] 没有找到 {onnx_path}，正在导出 ONNX 模型...")
+    model = AutoModel.from_pretrained(model_path).eval()
+    dummy = AutoTokenizer.from_pretrained(model_path)(["warm up"], return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    tmp_path = onnx_path + ".tmp"
+    torch.onnx.export(
+        model,
+        tuple(dummy[name] for name in input_names),
+        tmp_path,
+        input_names=input_names,
+        output_names=["last_hidden_state"],
+        dynamic_axes={name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]},
+        opset_version=14
+    )
+    os.replace(tmp_path, onnx_path) # 导出完整了才换上，避免半个文件被下次当成好的
+    return onnx_path
+
+def quantize_onnx(onnx_path):
+    '''
+    对 onnx 模型做 int8 动态量化（权重量化，激活运行时量化），返回量化后的文件路径
+    '''
+    int8_path = onnx_path.replace(".onnx", "_int8.onnx")
+    if os.path.exists(int8_path):
+        return int8_path
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    print(f"[Embedding] 正在生成 int8 量化模型: {int8_path}")
+    tmp_path = int8_path + ".tmp"
+    quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+    os.replace(tmp_path, int8_path)
+    return int8_path
+
+class OnnxEmbedder:
+    '''
+    用 ONNX Runtime 在 CPU 上跑 sentence-transformers 模型：
+    tokenizers 分词 -> onnx 前向 -> mean pooling -> L2 归一化，和 sentence-transformers 的输出一致（见 bench_embedding.py）
+    按 token 长度排序后分批，同一批句子长度相近，padding 最少
+    '''
+    def __init__(self,model_path,quantize=False,batch_size=EMBED_BATCH_SIZE,max_length=EMBED_MAX_LENGTH):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        onnx_path = export_onnx(model_path)
+        if quantize:
+            onnx_path = quantize_onnx(onnx_path)
+        self.onnx_path = onnx_path
+        self.batch_size = batch_size
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.no_padding() # padding 我们自己按批做
+
+        self.session = onnxruntime.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def __call__(self,input):
+        encodings = self.tokenizer.encode_batch(list(input))
+        order = sorted(range(len(encodings)), key=lambda i: len(encodings[i].ids))
+        embeddings = [None] * len(encodings)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            width = max(len(encodings[i].ids) for i in batch)
+            input_ids = np.zeros((len(batch), width), dtype=np.int64)
+            attention_mask = np.zeros((len(batch), width), dtype=np.int64)
+            for row, i in enumerate(batch):
+                ids = encodings[i].ids
+                input_ids[row, :len(ids)] = ids
+                attention_mask[row, :len(ids)] = 1
+
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self.input_names:
+                feeds["token_type_ids"] = np.zeros_like(input_ids)
+            hidden = self.session.run(None, feeds)[0]
+
+            # mean pooling（只算真实 token）+ L2 归一化
+            mask = attention_mask[..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            for row, i in enumerate(batch):
+                embeddings[i] = pooled[row].astype(np.float32)
+        return embeddings
+
+class LocalEmbeddingFunction(embedding_functions.EmbeddingFunction):
+    '''
+    本地 sentence-transformers 模型的嵌入函数：第一次真正编码时才加载模型（懒加载）
+    backend 选 torch（sentence-transformers）或 onnx（OnnxEmbedder），两者产出的向量可以混用
+    对 Chroma 来说它和 SentenceTransformerEmbeddingFunction 是同一种（name/config 一致），老集合可以直接打开
+    '''
+    def __init__(self,model_path,backend=EMBED_BACKEND,quantize=EMBED_QUANTIZE):
+        self.model_path = model_path
+        self.backend = backend
+        self.quantize = quantize
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    print(f"[Embedding] 正在加载模型 ({self.backend}): {self.model_path}")
+                    if self.backend == "onnx":
+                        self._model = OnnxEmbedder(self.model_path, quantize=self.quantize)
+                    else:
+                        self._model = embedding_functions.SentenceTransformerEmbeddingFunction(
+                            model_name = self.model_path
+                        )
+        return self._model
+
+    def __call__(self,input):
+        return self._load()(input)
+
+    @property
+    def model_key(self):
+        '''
+        模型标识（磁盘向量缓存按它区分）：torch 和 onnx fp32 的向量一致可以共用，int8 量化的单独存
+        '''
+        key = os.path.basename(os.path.normpath(self.model_path))
+        if self.backend == "onnx" and self.quantize:
+            key += "-int8"
+        return key
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def warm_up(self):
+        '''
+        提前加载模型并跑一次前向，避免第一个请求等模型加载
+        '''
+        self(["warm up"])
+
+    @staticmethod
+    def name():
+        return "sentence_transformer"
+
+    def get_config(self):
+        return {"model_name": self.model_path, "device": "cpu", "normalize_embeddings": False, "kwargs": {}}
+
+    @staticmethod
+    def build_from_config(config):
+        return LocalEmbeddingFunction(config["model_name"])
 
 class VectorMemory:
-    def __init__(self,collection_name='memory_core'):
+    def __init__(self,collection_name='memory_core',chunk_collection_name='paper_chunks'):
         #1.初始化客户端
         self.client = chromadb.PersistentClient(path='./chroma_db')
 
@@ -15,107 +253,453 @@ class VectorMemory:
         current_dir = os.path.dirname(os.path.abspath(__file__))
         self.local_model_path = os.path.join(current_dir, 'models', 'all-MiniLM-L6-v2')
     
-        self.embedding_func = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name = self.local_model_path
+        #懒加载：建实例时不加载模型，第一次编码（或 warm_up）时才加载
+        self.embedding_func = LocalEmbeddingFunction(self.local_model_path)
+
+        #记忆的写入序号（跨进程共用的计数器，见 write_sequence.py）
+        self.write_sequence = WriteSequence()
+
+        #文档向量的磁盘缓存：重建集合时不用再跑模型
+        self.embedding_store = EmbeddingStore(self.embedding_func.model_key)
+        #查询向量缓存
+        self.query_cache = EmbeddingCache(
+            max_entries=int(os.getenv("EMBED_CACHE_ENTRIES", "4096")),
+            max_bytes=int(float(os.getenv("EMBED_CACHE_MB", "64")) * 1024 * 1024)
         )
 
+        #关键词索引（和下面两个集合同步写入，混合检索用）
+        self.lexical_index = LexicalIndex()
+
         #3.创建记忆集合
         self.collection = self.client.get_or_create_collection(
             name=collection_name,
             embedding_function=self.embedding_func
         )
 
+        #4.论文全文切块的专用集合（按 paper_db_id 区分）
+        self.chunk_collection = self.client.get_or_create_collection(
+            name=chunk_collection_name,
+            embedding_function=self.embedding_func
+        )
+
+    def warm_up(self):
+        '''
+        预热：加载模型
+        '''
+        self.embedding_func.warm_up()
+        print("[Embedding] 模型预热完成")
+
     def add_memory(self,text,metadata=None,mem_id=None):
         '''
-        存储记忆
+        存储记忆（单条，内部走 add_memories）
         text:记忆内容
         metadata:附加信息（时间、来自用户还是ai）
-        mem_id:唯一id
+        mem_id:唯一id，不传就按内容哈希生成
+        '''
+        return self.add_memories([text], metadatas=[metadata], ids=[mem_id])[0]
+
+    def add_memories(self,texts,metadatas=None,ids=None):
+        '''
+        批量存储记忆：一次模型前向编码整批文本，按 Chroma 的最大批量分块 upsert
+        texts:记忆内容列表
+        metadatas:附加信息列表，与 texts 一一对应
+        ids:唯一id列表，某一项为 None 时按内容哈希生成（重复执行不会写出重复记忆）
+        返回实际写入的 id 列表
+        '''
+        # 每条记忆都打上数值时间戳；写入序号在真正写入时才分配（见 _upsert），sleep 按序号增量读取
+        stamped = []
+        for meta in (metadatas or [None] * len(texts)):
+            meta = dict(meta or {})
+            meta.setdefault("ts", time.time())
+            stamped.append(meta)
+        return self._upsert(self.collection, texts, stamped, ids, sequenced=True)
+
+    def _upsert(self,collection,texts,metadatas=None,ids=None,sequenced=False):
+        '''
+        往指定集合里批量 upsert，按 Chroma 的最大批量分块，每块一次模型前向
+        sequenced:给每条打上写入序号。先编码，再拿着计数器的写锁分配序号并 upsert，
+        所有写入者排队执行，序号大的一定后可见，增量读取不会漏掉"序号小但还没写完"的记忆
         '''
-        if mem_id == None:
-            import time
-            mem_id = str(time.time())
+        if not texts:
+            return []
+        metadatas = list(metadatas) if metadatas else [None] * len(texts)
+        ids = list(ids) if ids else [None] * len(texts)
+        ids = [mem_id or self.make_memory_id(text, meta) for text, meta, mem_id in zip(texts, metadatas, ids)]
 
-        self.collection.add(
-            documents=[text], #原始文字
-            metadatas=[metadata], #附加标记
-            ids=[mem_id] #timestamp
+        # 同一批里 id 重复时，后面的覆盖前面的（upsert 不允许一批内重复 id）
+        batch = {}
+        for mem_id, text, meta in zip(ids, texts, metadatas):
+            batch[mem_id] = (text, meta)
+        batch_ids = list(batch.keys())
+        batch_docs = [batch[i][0] for i in batch_ids]
+        batch_metas = [batch[i][1] for i in batch_ids]
+
+        max_batch = self.client.get_max_batch_size()
+        for start in range(0, len(batch_ids), max_batch):
+            end = start + max_batch
+            embeddings = self.embed_documents(batch_docs[start:end])
+            if not sequenced:
+                self._write_batch(collection, batch_ids[start:end], batch_docs[start:end], batch_metas[start:end], embeddings)
+                continue
+            with self.write_sequence.allocate(collection.name, end - start) as first:
+                for offset, meta in enumerate(batch_metas[start:end]):
+                    meta["seq"] = first + offset
+                self._write_batch(collection, batch_ids[start:end], batch_docs[start:end], batch_metas[start:end], embeddings)
+        self.lexical_index.upsert(collection.name, batch_ids, batch_docs, batch_metas)
+        print(f"[Chroma] 已存入 {len(batch_ids)} 条: {batch_docs[0][:20]}...")
+        return ids
+
+    @staticmethod
+    def _write_batch(collection,ids,documents,metadatas,embeddings):
+        collection.upsert(
+            ids=ids,
+            documents=documents, #原始文字
+            metadatas=metadatas, #附加标记
+            embeddings=embeddings
         )
-        print(f"[Chroma] 已存入: {text[:20]}...")
+
+    def embed_documents(self,texts):
+        '''
+        文档编码：先查磁盘向量缓存，只有没见过的文本才跑模型，算完写回缓存
+        '''
+        vectors = self.embedding_store.get_many(texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            computed = self.embedding_func([texts[i] for i in missing])
+            self.embedding_store.put_many([texts[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        return vectors
+
+    @staticmethod
+    def make_memory_id(text,metadata=None):
+        '''
+        按内容生成确定性的 id：同一个用户/Idea/角色下的同一段文字永远是同一个 id
+        （不含时间戳，所以重跑睡眠或重复上传都是幂等的）
+        '''
+        meta = metadata or {}
+        scope = "|".join(str(meta.get(k, "")) for k in ("user_id", "idea_id", "paper_db_id", "role"))
+        digest = hashlib.sha256(f"{scope}|{text}".encode("utf-8")).hexdigest()
+        return f"mem_{digest[:32]}"
     
-    def get_new_memory_for_sleep(self,last_timestamp='1970-01-01 00:00:00',limit=100):
-        '''
-        为sleep准备数据
-        last_timestamp:上次运行sleep的时间
-        limit:读取记忆限制数目
-        '''
-        new_memory = self.collection.get(
-            limit=limit,
-            include=['documents','metadatas']
-        ) 
-        new_memories = []
-        if new_memory["ids"]:
-            for i in range(len(new_memory["ids"])):
-                meta = new_memory['metadatas'][i]
-                doc = new_memory["documents"][i]
-                mem_time = meta.get("timestamp",'0000-00-00')
-
-                #筛选上次sleep后的数据
-                if last_timestamp < mem_time:
-                    new_memories.append({
-                        'content':doc,
-                        'metadata':meta
-                    })
-        #按时间排序
-        new_memories.sort(key=lambda x: x['metadata'].get('timestamp',''))
-        return new_memories
-
-    def search_memory(self,query_text,n_results=3,threshold=1,filter_metadata=None):
-        '''
-        检索记忆
+    def get_new_memory_for_sleep(self,last_seq=0,page_size=100,filter_metadata=None):
+        '''
+        为sleep准备数据（生成器）：只读上次检查点之后写入的记忆
+        last_seq:上次 sleep 读到的最大序号（检查点），0 表示从头读
+        page_size:每页从 Chroma 读多少条
+        filter_metadata:额外的过滤条件，比如 {"user_id": 1}
+        "seq > last_seq" 直接下推到 Chroma 的 where 里，再用 offset/limit 翻页，
+        不管集合多大都只扫增量；调用方读完后把见到的最大 seq 存成新的检查点
+        '''
+        where = {"seq": {"$gt": last_seq}}
+        if filter_metadata:
+            where = {"$and": [where, filter_metadata]}
+        offset = 0
+        while True:
+            page = self.collection.get(
+                where=where,
+                limit=page_size,
+                offset=offset,
+                include=['documents','metadatas']
+            )
+            if not page["ids"]:
+                break
+            memories = [
+                {'id': mem_id, 'content': doc, 'metadata': meta, 'seq': meta.get('seq', 0)}
+                for mem_id, doc, meta in zip(page["ids"], page["documents"], page["metadatas"])
+            ]
+            #页内按写入顺序排序
+            memories.sort(key=lambda x: x['seq'])
+            yield from memories
+            if len(page["ids"]) < page_size:
+                break
+            offset += page_size
+
+    def backfill_sequence(self,page_size=500):
+        '''
+        给老数据补上 ts/seq（老数据只有字符串 timestamp，按它换算），一次性迁移用
+        连 timestamp 都没有的记为 seq=1（检查点从 0 开始，第一次 sleep 仍然能读到）
+        补完在计数器里记一个标记，之后再调用直接返回 0
+        返回补了多少条
+        '''
+        flag = f"backfilled:{self.collection.name}"
+        if self.write_sequence.has_flag(flag):
+            return 0
+        updated = 0
+        offset = 0
+        while True:
+            page = self.collection.get(limit=page_size, offset=offset, include=['metadatas'])
+            if not page["ids"]:
+                break
+            ids = []
+            metadatas = []
+            for mem_id, meta in zip(page["ids"], page["metadatas"]):
+                meta = dict(meta or {})
+                if "seq" in meta:
+                    continue
+                try:
+                    ts = datetime.datetime.strptime(meta.get("timestamp", ""), "%Y-%m-%d %H:%M:%S").timestamp()
+                except ValueError:
+                    ts = 0.0
+                meta["ts"] = ts
+                meta["seq"] = max(int(ts * 1_000_000), 1)
+                ids.append(mem_id)
+                metadatas.append(meta)
+            if ids:
+                self.collection.update(ids=ids, metadatas=metadatas)
+                updated += len(ids)
+            if len(page["ids"]) < page_size:
+                break
+            offset += page_size
+        self.write_sequence.set_flag(flag)
+        if updated:
+            print(f"[Chroma] 已给 {updated} 条老记忆补上写入序号")
+        return updated
+
+    def search_memory(self,query_text,n_results=3,threshold=1,filter_metadata=None,mode=None):
+        '''
+        检索记忆（单条问题，内部走 search_many）
         query_text:检索的问题
         n_result:返回几条
         filter_metadata=None:默认全局搜索
+        mode:hybrid / dense，默认读 SEARCH_MODE
         '''
-        results = self.collection.query(
-            query_texts=[query_text],
-            n_results=n_results
-        )
+        return self.search_many(
+            [query_text],
+            n_results=n_results,
+            threshold=threshold,
+            filter_metadata=filter_metadata,
+            mode=mode
+        )[0]
 
+    def search_many(self,query_texts,n_results=3,threshold=1,filter_metadata=None,mode=None):
+        '''
+        批量检索：所有问题一次前向计算得到向量，再一次 query，返回与 query_texts 一一对应的结果列表
+        query_texts:问题列表
+        n_result:每个问题返回几条
+        threshold:距离阈值，超过的丢掉（只作用于向量那一路）
+        filter_metadata=None:默认全局搜索
+        mode:hybrid / dense，默认读 SEARCH_MODE
+        '''
+        if not query_texts:
+            return []
         # 如果 filter_metadata 是 None，它就会进行全局搜索（联想模式的基础）
         # 例如 {"idea_id": 1}，它就只搜这个 Idea 下的数据
-        results = self.collection.query(
-            query_texts=[query_text],
-            n_results=n_results,
-            where=filter_metadata 
+        return self._query(self.collection, query_texts, n_results, threshold, filter_metadata, mode)
+
+    def _query(self,collection,query_texts,n_results,threshold,filter_metadata,mode=None):
+        '''
+        在指定集合里做批量检索，返回与 query_texts 一一对应的清洗后结果
+        hybrid 模式下向量和关键词各取 HYBRID_FETCH_K 条，按 RRF 融合后取前 n_results 条
+        '''
+        hybrid = (mode or SEARCH_MODE) == "hybrid"
+        fetch_k = max(n_results, HYBRID_FETCH_K) if hybrid else n_results
+        # 先查缓存，没命中的一次模型前向全部编码掉（而不是让 Chroma 每个问题各编一次）
+        query_embeddings = self.embed_queries(query_texts)
+        results = collection.query(
+            query_embeddings=query_embeddings,
+            n_results=fetch_k,
+            where=filter_metadata
         )
+        dense = [self._clean_results(results, q, threshold) for q in range(len(query_texts))]
+        if not hybrid:
+            return dense
+        return [
+            self._fuse(hits, self.lexical_index.search(collection.name, query, fetch_k, filter_metadata), n_results)
+            for query, hits in zip(query_texts, dense)
+        ]
+
+    def retrieve(self,query_text,k=3,threshold=1,filter_metadata=None,max_tokens=None,collection=None):
+        '''
+        给 prompt 用的检索：先多取 RERANK_FETCH_K 条候选，再重排（相关性 + MMR 多样性），
+        在 token 预算内返回最好的至多 k 条
+        collection:默认记忆集合
+        '''
+        collection = collection or self.collection
+        candidates = self._query(collection, [query_text], max(k, rerank.RERANK_FETCH_K), threshold, filter_metadata)[0]
+        if not candidates:
+            return []
+        query_vector = self.embed_queries([query_text])[0]
+        # 候选的文档向量在写入时就进了磁盘缓存，这里基本不用再跑模型
+        doc_vectors = self.embed_documents([c['content'] for c in candidates])
+        return rerank.rerank(query_text, query_vector, candidates, doc_vectors, k=k, max_tokens=max_tokens)
+
+    @staticmethod
+    def _fuse(dense_hits,lexical_hits,n_results):
+        '''
+        倒数排名融合（RRF）：每一路里排第 r 名得 1/(RRF_K + r) 分，两路都命中的分数相加
+        只看名次不看分值，向量距离和 bm25 分数不用互相换算
+        '''
+        fused = {}
+        for hits in (dense_hits, lexical_hits):
+            for rank, hit in enumerate(hits, start=1):
+                entry = fused.setdefault(hit['id'], {
+                    'id': hit['id'],
+                    'content': hit['content'],
+                    'metadata': hit['metadata'],
+                    'distance': hit.get('distance'),
+                    'score': 0.0
+                })
+                entry['score'] += 1.0 / (RRF_K + rank)
+        ranked = sorted(fused.values(), key=lambda x: x['score'], reverse=True)
+        clean_result = []
+        seen_content = set()
+        for hit in ranked:
+            if hit['content'] in seen_content:
+                continue
+            seen_content.add(hit['content'])
+            clean_result.append(hit)
+        return clean_result[:n_results]
 
-        #对返回的数据做数据清洗
-        # results['documents'][0] 是内容列表，n个query，n个列表[text1,text2...]
-        # results['distances'][0] 是距离列表，每个text对应的距离
-        # results['metadatas'][0] 是元数据列表,metadata={
+    @staticmethod
+    def idea_filter(idea_id):
+        '''
+        只搜某个 Idea 的过滤条件
+        记忆要么本来就属于这个 Idea (idea_id)，要么是被复用到这个 Idea 的论文 (in_idea_<id> 标记)
+        '''
+        return {"$or": [{"idea_id": idea_id}, {f"in_idea_{idea_id}": True}]}
+
+    def add_idea_membership(self,mem_ids,idea_id):
+        '''
+        让已有的记忆同时属于另一个 Idea（同一篇论文上传到多个 Idea 时用，不重新编码）
+        '''
+        if not mem_ids:
+            return
+        got = self.collection.get(ids=list(mem_ids), include=['metadatas'])
+        if not got['ids']:
+            return
+        metadatas = []
+        for meta in got['metadatas']:
+            meta = dict(meta or {})
+            meta[f"in_idea_{idea_id}"] = True
+            metadatas.append(meta)
+        self.collection.update(ids=got['ids'], metadatas=metadatas)
+        self.lexical_index.update_metadata(self.collection.name, got['ids'], metadatas)
+
+    def index_paper_chunks(self,paper_db_id,chunks,metadata=None):
+        '''
+        把论文全文切好的块存入专用集合
+        paper_db_id:SQL 里的论文 id
+        chunks:chunker 切出来的块 [{"text","section","index"}]
+        metadata:每块都要带上的公共信息（user_id、idea_id 等）
+        '''
+        texts = []
+        metadatas = []
+        ids = []
+        for chunk in chunks:
+            meta = dict(metadata or {})
+            meta.update({
+                "paper_db_id": paper_db_id,
+                "section": chunk["section"],
+                "chunk_index": chunk["index"]
+            })
+            texts.append(chunk["text"])
+            metadatas.append(meta)
+            ids.append(f"paper_{paper_db_id}_chunk_{chunk['index']}")
+        return self._upsert(self.chunk_collection, texts, metadatas, ids)
+
+    def has_paper_chunks(self,paper_db_id):
+        '''
+        这篇论文的全文是否已经切块入库（老数据可能没有）
+        '''
+        got = self.chunk_collection.get(where={"paper_db_id": paper_db_id}, limit=1, include=[])
+        return bool(got["ids"])
+
+    def search_paper_chunks(self,query_text,paper_db_id,n_results=8,threshold=2,max_tokens=None):
+        '''
+        在某一篇论文的全文块里检索和问题最相关的至多 n_results 块（经过重排、不超过 token 预算），按原文顺序返回
+        threshold 比普通检索宽一些：范围已经锁死在这篇论文里了
+        '''
+        hits = self.retrieve(
+            query_text,
+            k=n_results,
+            threshold=threshold,
+            filter_metadata={"paper_db_id": paper_db_id},
+            max_tokens=max_tokens,
+            collection=self.chunk_collection
+        )
+        hits.sort(key=lambda x: x['metadata'].get('chunk_index', 0))
+        return hits
+
+    def embed_queries(self,query_texts):
+        '''
+        把问题编码成向量（float32），优先走缓存
+        '''
+        keys = [(self.local_model_path, EmbeddingCache.normalize(t)) for t in query_texts]
+        vectors = [self.query_cache.get(k) for k in keys]
+
+        # 没命中的去重后一起算
+        missing = list(dict.fromkeys(k for k, v in zip(keys, vectors) if v is None))
+        if missing:
+            computed = self.embedding_func([k[1] for k in missing])
+            fresh = {}
+            for k, vec in zip(missing, computed):
+                fresh[k] = np.asarray(vec, dtype=np.float32)
+                self.query_cache.put(k, fresh[k])
+            vectors = [v if v is not None else fresh[k] for k, v in zip(keys, vectors)]
+        return vectors
+
+    def _clean_results(self,results,q,threshold):
+        '''
+        对返回的数据做数据清洗
+        q:第几个 query 的结果
+        '''
+        # results['documents'][q] 是内容列表，n个query，n个列表[text1,text2...]
+        # results['distances'][q] 是距离列表，每个text对应的距离
+        # results['metadatas'][q] 是元数据列表,metadata={
         #"role": "user",# 是谁说的？
         #"timestamp": "2023-10-27..."  # 什么时候说的？}
         clean_result = []
         seen_content = set() #初始化一个集合，用来记录见过的内容
         if results['documents']:
-            for i,doc in enumerate(results['documents'][0]): #i是索引，doc是文本内容
+            for i,doc in enumerate(results['documents'][q]): #i是索引，doc是文本内容
                 #阈值限制
-                if results["distances"][0][i] > threshold:
+                if results["distances"][q][i] > threshold:
                     continue
                 #去重
                 if doc in seen_content:
                     continue
                 seen_content.add(doc)
-                meta = results['metadatas'][0][i]
-                distance = results["distances"][0][i]
+                meta = results['metadatas'][q][i]
+                distance = results["distances"][q][i]
                 clean_result.append({
+                    'id':results['ids'][q][i],
                     'content':doc,
                     'metadata':meta,
                     'distance':distance
                 })
         return clean_result
     
+# ================= 进程内共享的向量库 =================
+# services / sleep 等模块都通过 get_memory_core() 拿同一个实例，
+# 模型和 PersistentClient 整个进程只加载一份；测试时可以用 set_memory_core() 注入假的实例
+_memory_core = None
+_memory_core_lock = threading.Lock()
+
+def get_memory_core():
+    global _memory_core
+    if _memory_core is None:
+        with _memory_core_lock:
+            if _memory_core is None:
+                _memory_core = VectorMemory()
+    return _memory_core
+
+def set_memory_core(memory):
+    '''
+    替换全局实例（测试注入用），传 None 则下次 get 时重新创建
+    '''
+    global _memory_core
+    with _memory_core_lock:
+        _memory_core = memory
+
+def warm_up_in_background():
+    '''
+    在后台线程里加载模型，不拖慢服务启动
+    '''
+    thread = threading.Thread(target=lambda: get_memory_core().warm_up(), name="embedding-warmup", daemon=True)
+    thread.start()
+    return thread
+
 if __name__ == "__main__":
     # 测试代码
     vm = VectorMemory()
@@ -0,0 +1,55 @@
+'''
+此代码是记忆集合的写入序号（跨进程共用一个 SQLite 计数器）
+sleep 按 "seq > 检查点" 增量读记忆，要求序号大的记忆一定比序号小的后写进 Chroma，否则读过去就永远漏掉了
+- 分配序号时开一个 BEGIN IMMEDIATE 事务，一直拿着写锁直到这批 upsert 完成才提交
+  API 进程、单独跑的 sleep.py、多个线程同时写时，分配和写入按同一个顺序串行，序号顺序 = 写入顺序
+- 文本编码在拿锁之前就做完了，锁里只有 Chroma 的 upsert
+- 计数器起点取当前微秒时间，和老数据（按时间戳换算出的序号）兼容，计数器文件丢了也不会倒退
+'''
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# 计数器文件
+MEMORY_SEQ_PATH = os.getenv("MEMORY_SEQ_PATH", "./memory_seq.sqlite")
+
+class WriteSequence:
+    def __init__(self,path=MEMORY_SEQ_PATH):
+        self._lock = threading.Lock()
+        # isolation_level=None：事务自己用 BEGIN/COMMIT 控制
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS flags (name TEXT PRIMARY KEY)")
+
+    @contextmanager
+    def allocate(self,name,count):
+        '''
+        分配 count 个连续序号，返回第一个；with 块结束（写入完成）才提交，期间其他写入者排队
+        with 块里抛异常则回滚，这批序号作废
+        '''
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+                first = max(row[0] + 1 if row else 0, time.time_ns() // 1000)
+                self._db.execute(
+                    "INSERT INTO counters (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                    (name, first + count - 1)
+                )
+                yield first
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def has_flag(self,name):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM flags WHERE name = ?", (name,)).fetchone() is not None
+
+    def set_flag(self,name):
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO flags (name) VALUES (?)", (name,))